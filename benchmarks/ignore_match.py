@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Time the ``.couchappignore`` checks of a synthetic tree: the former loop
+matching each pattern against each sub path, ``IgnoreMatcher`` on full
+paths, and ``IgnoreMatcher`` checking only the last component of each
+entry, as the tree walks do. The three must agree::
+
+    python benchmarks/ignore_match.py --paths 10000 --depth 7
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from copy import copy
+from itertools import chain
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from couchapp import util  # noqa: E402
+from couchapp.localdoc import IgnoreMatcher  # noqa: E402
+
+PATTERNS = [r'.*\.bak', r'.*~', r'\.git', r'node_modules', r'tmp/.*\.log']
+
+
+def legacy_check_ignore(ignores, item):
+    """ ``LocalDoc.check_ignore`` before ``IgnoreMatcher`` """
+    item = os.path.normpath(item)
+    for pattern in ignores:
+        paths = chain(legacy_combine_path(item),
+                      legacy_combine_path('/' + item))
+        if any(re.match(pattern + '$', i) for i in paths):
+            return True
+    return False
+
+
+def legacy_combine_path(p):
+    ls = util.split_path(p)
+    while ls:
+        for i in legacy_combine_dir(copy(ls)):
+            yield i
+        ls.pop(0)
+
+
+def legacy_combine_dir(ls):
+    ret = tuple()
+    while ls:
+        ret += (ls.pop(0),)
+        yield '/'.join(ret)
+
+
+def make_paths(count, depth, seed):
+    """ ``count`` relative paths of ``depth`` components, a few of them
+    ignored """
+    rnd = random.Random(seed)
+    names = ['lib', 'views', 'shows', 'tmp', 'node_modules', 'vendor',
+             'css', 'js', 'img', 'templates']
+    files = ['index.js', 'map.js', 'style.css', 'a.bak', 'b.js~', 'run.log',
+             'doc.json', 'logo.png']
+    return ['/'.join([rnd.choice(names) for _ in range(depth - 1)] +
+                     [rnd.choice(files)]) for _ in range(count)]
+
+
+def timed(label, func, paths):
+    start = time.perf_counter()
+    result = [func(p) for p in paths]
+    print('%-28s %.3fs' % (label, time.perf_counter() - start))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--paths', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = make_paths(args.paths, args.depth, args.seed)
+    matcher = IgnoreMatcher(PATTERNS)
+    print('%d paths of depth %d, %d patterns' % (len(paths), args.depth,
+                                                 len(PATTERNS)))
+
+    legacy = timed('per-pattern loop',
+                   lambda p: legacy_check_ignore(PATTERNS, p), paths)
+    full = timed('IgnoreMatcher', matcher.match, paths)
+
+    # the walks check each directory once, before its entries, and only
+    # descend in the directories which aren't ignored
+    dirs = {}
+
+    def walk_check(path):
+        parts = path.split('/')
+        for i in range(1, len(parts) + 1):
+            sub = '/'.join(parts[:i])
+            ignored = dirs.get(sub)
+            if ignored is None:
+                ignored = matcher.match(sub, parent_checked=i > 1)
+                if i < len(parts):
+                    dirs[sub] = ignored
+            if ignored:
+                return True
+        return False
+
+    entry = timed('IgnoreMatcher per entry', walk_check, paths)
+    if not legacy == full == entry:
+        sys.exit('the checks disagree')
+    print('%d ignored, all checks agree' % sum(legacy))
+
+
+if __name__ == '__main__':
+    main()
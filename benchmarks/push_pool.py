@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Count the TCP connections and time the push of a generated CouchApp with
+pooled keep-alive connections against one connection per request
+(``"http": {"keepalive": false}``).
+
+The push goes to a minimal in-memory stand-in of CouchDB served from the
+same process, which counts the connections it accepts::
+
+    python benchmarks/push_pool.py --attachments 200 --docs 200 --atomic
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from couchapp import client, commands  # noqa: E402
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ the requests of a push: databases, documents, attachments,
+    ``_bulk_docs`` and ``_all_docs`` by keys. Documents are kept in
+    ``server.dbs``, attachments aren't stored. """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, obj=None):
+        body = json.dumps(obj).encode('utf-8') if obj is not None else b''
+        self.send_response(code)
+        if self.headers.get('Connection', '').lower() == 'close':
+            self.send_header('Connection', 'close')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def save(self, docs, docid, doc):
+        cur = docs.get(docid)
+        if (cur or {}).get('_rev') != doc.get('_rev'):
+            return {'id': docid, 'error': 'conflict'}
+        rev = int(cur['_rev'].split('-')[0]) + 1 if cur else 1
+        doc.update(_id=docid, _rev='%d-%s' % (rev, uuid.uuid4().hex))
+        docs[docid] = doc
+        return {'ok': True, 'id': docid, 'rev': doc['_rev']}
+
+    def handle_request(self):
+        with self.server.lock:
+            self.server.requests += 1
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        body = self.read_body()
+        dbs, method = self.server.dbs, self.command
+
+        if not parts:
+            return self.reply(200, {'couchdb': 'Welcome', 'version': '1.6.1'})
+        if parts[0] == '_uuids':
+            count = int(query.get('count', 1))
+            return self.reply(200, {'uuids': [uuid.uuid4().hex
+                                              for _ in range(count)]})
+        dbname, rest = parts[0], parts[1:]
+        if not rest:
+            if method == 'PUT':
+                if dbname in dbs:
+                    return self.reply(412, {'error': 'file_exists'})
+                dbs[dbname] = {}
+                return self.reply(201, {'ok': True})
+            if dbname not in dbs:
+                return self.reply(404, {'error': 'not_found'})
+            return self.reply(200, {'db_name': dbname})
+        docs = dbs.get(dbname)
+        if docs is None:
+            return self.reply(404, {'error': 'not_found'})
+
+        if rest == ['_bulk_docs']:
+            return self.reply(201, [self.save(docs, d.get('_id'), d)
+                                    for d in json.loads(body)['docs']])
+        if rest == ['_all_docs']:
+            rows = [{'id': k, 'key': k, 'value': {'rev': docs[k]['_rev']}}
+                    if k in docs else {'key': k, 'error': 'not_found'}
+                    for k in json.loads(body)['keys']]
+            return self.reply(200, {'total_rows': len(docs), 'offset': 0,
+                                    'rows': rows})
+
+        if rest[0] == '_design':
+            docid, attachment = '/'.join(rest[:2]), rest[2:]
+        else:
+            docid, attachment = rest[0], rest[1:]
+        cur = docs.get(docid)
+        if attachment:
+            if cur is None or cur['_rev'] != query.get('rev'):
+                return self.reply(409, {'error': 'conflict'})
+            return self.reply(201, self.save(docs, docid, dict(cur)))
+        if method == 'GET':
+            if cur is None:
+                return self.reply(404, {'error': 'not_found'})
+            return self.reply(200, cur)
+        if method == 'PUT':
+            result = self.save(docs, docid, json.loads(body))
+            return self.reply(409 if 'error' in result else 201, result)
+        self.reply(405, {'error': 'method_not_allowed'})
+
+    do_GET = do_HEAD = do_PUT = do_POST = handle_request
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.dbs = {}
+    server.connections = server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_app(path, attachments, docs):
+    """ an app with ``attachments`` small attachments and ``docs``
+    documents in ``_docs`` """
+    os.makedirs(os.path.join(path, '_attachments'))
+    os.makedirs(os.path.join(path, '_docs'))
+    os.makedirs(os.path.join(path, 'shows'))
+    with open(os.path.join(path, 'shows', 'hello.js'), 'w') as f:
+        f.write('function(doc, req) { return "hello"; }\n')
+    for i in range(attachments):
+        with open(os.path.join(path, '_attachments', 'a%04d.js' % i), 'w') as f:
+            f.write(('// attachment %d\n' % i) * 20)
+    for i in range(docs):
+        with open(os.path.join(path, '_docs', 'd%04d.json' % i), 'w') as f:
+            json.dump({'value': i}, f)
+
+
+def push(path, server, keepalive, noatomic, jobs):
+    """ push the app to a new database of ``server``, return the time
+    taken and the connections and requests it made """
+    with open(os.path.join(path, '.couchapprc'), 'w') as f:
+        json.dump({'http': {'keepalive': keepalive}}, f)
+
+    dburl = 'http://127.0.0.1:%d/bench_pool_%s' % (server.server_port,
+                                                   uuid.uuid4().hex)
+    opts = argparse.Namespace(export=False, output=None, no_atomic=noatomic,
+                              force=True, no_build_cache=True, jobs=jobs)
+    client.close_sessions()
+    with server.lock:
+        server.connections = server.requests = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        commands.push(path, dburl, opts)
+    elapsed = time.perf_counter() - start
+    client.close_sessions()
+    return elapsed, server.connections, server.requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--attachments', type=int, default=200)
+    parser.add_argument('--docs', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--atomic', action='store_true',
+                        help='push in bulk instead of one request per '
+                             'attachment and document')
+    args = parser.parse_args()
+
+    server = start_server()
+    path = os.path.join(tempfile.mkdtemp(), 'benchapp')
+    try:
+        make_app(path, args.attachments, args.docs)
+        for keepalive in (False, True):
+            runs = [push(path, server, keepalive, not args.atomic, args.jobs)
+                    for _ in range(args.repeat)]
+            times = [elapsed for elapsed, _, _ in runs]
+            _, connections, requests = runs[-1]
+            print('%-10s %5d connections %5d requests  median %.3fs  '
+                  'min %.3fs  (%d runs)' % (
+                      'pooled' if keepalive else 'unpooled', connections,
+                      requests, statistics.median(times), min(times),
+                      args.repeat))
+    finally:
+        shutil.rmtree(os.path.dirname(path))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Time the attachment signatures: the former md5 with 8 KiB reads against
+``util.sign`` with each algorithm of ``SIGNATURE_ALGORITHMS`` (xxhash ones
+only when the package is installed), on many small files and on a large
+one hashed through mmap or by buffered reads::
+
+    python benchmarks/sign_hash.py --small 2000 --large-mb 256
+
+The files are written to a temporary directory, a first pass warms the
+page cache so that the hashing, not the disk, is measured.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from couchapp import util  # noqa: E402
+
+
+def legacy_sign(fpath, algorithm=None):
+    """ ``util.sign`` before the algorithms and mmap """
+    m = hashlib.md5()
+    with open(fpath, 'rb') as fp:
+        while 1:
+            data = fp.read(8096)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
+
+
+def make_files(path, small, small_size, large_mb):
+    smalls = []
+    for i in range(small):
+        fpath = os.path.join(path, 's%05d' % i)
+        with open(fpath, 'wb') as f:
+            f.write(os.urandom(small_size))
+        smalls.append(fpath)
+    large = os.path.join(path, 'large')
+    with open(large, 'wb') as f:
+        for _ in range(large_mb):
+            f.write(os.urandom(1024 * 1024))
+    return smalls, large
+
+
+def timed(func, files, repeat):
+    """ best time of ``repeat`` passes of ``func`` over ``files`` """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for fpath in files:
+            func(fpath)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--small', type=int, default=2000,
+                        help='number of small files')
+    parser.add_argument('--small-size', type=int, default=4096,
+                        help='size of the small files in bytes')
+    parser.add_argument('--large-mb', type=int, default=256,
+                        help='size of the large file in MiB')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp()
+    try:
+        smalls, large = make_files(path, args.small, args.small_size,
+                                   args.large_mb)
+        timed(legacy_sign, smalls + [large], 1)
+
+        print('%-22s %12s %12s %12s' % (
+            '', '%d x %dB' % (args.small, args.small_size),
+            '%dMiB mmap' % args.large_mb, '%dMiB read' % args.large_mb))
+        print('%-22s %11.3fs %12s %11.3fs' % (
+            'md5 (former, 8KiB)', timed(legacy_sign, smalls, args.repeat), '',
+            timed(legacy_sign, [large], args.repeat)))
+
+        mmap_size = util.SIGN_MMAP_SIZE
+        for algorithm in sorted(util.SIGNATURE_ALGORITHMS):
+            def sign(fpath):
+                return util.sign(fpath, algorithm)
+
+            small_time = timed(sign, smalls, args.repeat)
+            util.SIGN_MMAP_SIZE = 0
+            mmap_time = timed(sign, [large], args.repeat)
+            util.SIGN_MMAP_SIZE = float('inf')
+            read_time = timed(sign, [large], args.repeat)
+            util.SIGN_MMAP_SIZE = mmap_size
+            print('%-22s %11.3fs %11.3fs %11.3fs' % (
+                algorithm, small_time, mmap_time, read_time))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+asyncio counterpart of ``couchapp.client``, built on ``aiohttp``: a single
+event loop can keep thousands of requests in flight without a thread for
+each of them. ``aiohttp`` is an optional dependency.
+"""
+
+import asyncio
+import json
+import logging
+from collections import deque
+from urllib.parse import quote, urlsplit
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from couchapp.client import USER_AGENT, DEFAULT_POOL_SIZE, \
+    DEFAULT_MAX_RETRIES, DEFAULT_KEEPALIVE, BULK_BATCH_SIZE, \
+    BULK_BATCH_BYTES, Database, aliases, encode_params, escape_docid, \
+    raise_for_status, _bulk_batches, _existing_dbs, \
+    _existing_dbs_lock, _view_request
+from couchapp.errors import AppError, BulkSaveError, InvalidAttachment, \
+    PreconditionFailed, RequestFailed, ResourceConflict, ResourceNotFound
+
+logger = logging.getLogger(__name__)
+
+# status codes retried like ``client.get_session`` does
+RETRY_STATUSES = (502, 503, 504)
+RETRY_BACKOFF = 0.1
+
+_sessions = {}
+
+
+def require_aiohttp():
+    """ raise an ``AppError`` if ``aiohttp`` isn't installed """
+    if aiohttp is None:
+        raise AppError("the asyncio client requires the aiohttp package "
+                       "(pip install CMSCouchapp[async])")
+
+
+def get_session(uri, pool_size=DEFAULT_POOL_SIZE, keepalive=DEFAULT_KEEPALIVE,
+                use_proxy=True):
+    """
+    Return the ``aiohttp.ClientSession`` shared by all the resources of the
+    running event loop pointing to the same server. Must be called from a
+    coroutine.
+
+    :param pool_size: int, max number of connections open to the server
+    :param keepalive: bool, if False connections are closed after each request
+    :param use_proxy: bool, if True the ``http_proxy``/``https_proxy``
+        environment variables are honoured, as they are by ``requests``
+    """
+    require_aiohttp()
+
+    loop = asyncio.get_running_loop()
+    parts = urlsplit(uri)
+    hostport = parts.netloc.rsplit('@', 1)[-1]
+    key = (loop, parts.scheme, hostport, pool_size, keepalive, use_proxy)
+
+    session = _sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=pool_size,
+                                         force_close=not keepalive)
+        session = aiohttp.ClientSession(connector=connector,
+                                        headers={'User-Agent': USER_AGENT},
+                                        trust_env=use_proxy)
+        _sessions[key] = session
+    return session
+
+
+async def close_sessions():
+    """ close the sessions of the running event loop """
+    loop = asyncio.get_running_loop()
+    for key in [k for k in _sessions if k[0] is loop]:
+        await _sessions.pop(key).close()
+
+
+class AsyncCouchdbResource(object):
+
+    def __init__(self, uri="http://127.0.0.1:5984", **client_opts):
+        """Constructor for an `AsyncCouchdbResource` object, the asyncio
+        counterpart of `client.CouchdbResource`.
+
+        @param uri: str, full uri to the server.
+        @param pool_size, max_retries, keepalive, use_proxy: connection
+            pool settings, see `get_session`.
+        """
+        require_aiohttp()
+        self.uri = uri
+        self.client_opts = client_opts
+        self.max_retries = client_opts.get('max_retries', DEFAULT_MAX_RETRIES)
+
+    @property
+    def session(self):
+        return get_session(
+            self.uri,
+            pool_size=self.client_opts.get('pool_size', DEFAULT_POOL_SIZE),
+            keepalive=self.client_opts.get('keepalive', DEFAULT_KEEPALIVE),
+            use_proxy=self.client_opts.get('use_proxy', True))
+
+    async def request(self, method, path=None, payload=None, headers=None,
+                      params_dict=None, **params):
+        """ Perform an HTTP call to the couchdb server, see
+        `client.CouchdbResource.request`. Query parameters which aren't
+        strings are encoded in JSON.
+
+        @return: the decoded JSON body of the response, or its raw content
+            if it isn't JSON. Errors are raised as by
+            `client.CouchdbResponse.json_body`.
+        """
+        if path:
+            path = "{}/{}".format(self.uri, path)
+        else:
+            path = self.uri
+        headers = headers or {}
+        headers.setdefault('Accept', 'application/json')
+        query = dict(params_dict or {})
+        query.update(params)
+        query = encode_params(query)
+
+        logger.debug("Request: %s %s", method, path)
+
+        # like the urllib3 retries of the blocking client: connection
+        # errors and 502/503/504 are retried, not read errors. A streamed
+        # payload can't be sent twice
+        retries = self.max_retries if isinstance(payload, (str, bytes,
+                                                           type(None))) else 0
+        attempt = 0
+        while True:
+            try:
+                async with self.session.request(method, path, data=payload,
+                                                headers=headers,
+                                                params=query) as resp:
+                    if resp.status in RETRY_STATUSES and attempt < retries:
+                        raise _Retry()
+                    body = await resp.read()
+                    status, reason = resp.status, resp.reason
+            except _Retry:
+                pass
+            except aiohttp.ClientConnectorError as e:
+                # the connection couldn't be established, nothing was sent
+                if attempt >= retries:
+                    logger.exception("Error making an AsyncCouchdbResource "
+                                     "call. Details: %s", e)
+                    raise RequestFailed('unknown error [%s]', str(e))
+            except aiohttp.ClientError as e:
+                logger.exception("Error making an AsyncCouchdbResource call. "
+                                 "Details: %s", e)
+                raise RequestFailed('unknown error [%s]', str(e))
+            else:
+                break
+            attempt += 1
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+        if 200 <= status < 400:
+            logger.debug("Response status_code: %s", status)
+            try:
+                return json.loads(body)
+            except ValueError:
+                # No JSON object could be decoded
+                return body
+        raise_for_status(status, reason, body.decode('utf-8', 'replace'),
+                         "<Response [%s]>" % status)
+
+
+class _Retry(Exception):
+    """ retry a request """
+
+
+class AsyncDatabase(object):
+    """ asyncio counterpart of `client.Database`. The database isn't
+    created by the constructor, see `create`.
+    """
+
+    def __init__(self, uri, **client_opts):
+        if uri.endswith("/"):
+            uri = uri[:-1]
+
+        self.raw_uri = uri
+        self.res = AsyncCouchdbResource(uri=uri, **client_opts)
+        self.server_uri, self.dbname = uri.rsplit('/', 1)
+
+    async def create(self):
+        """ create the database unless it is known to exist, see
+        `client.Database.ensure_exists` """
+        if self.raw_uri in _existing_dbs:
+            return
+        try:
+            await self.res.request("HEAD")
+        except ResourceNotFound:
+            try:
+                await self.res.request("PUT")
+            except PreconditionFailed:
+                # created by someone else in the meantime
+                pass
+        with _existing_dbs_lock:
+            _existing_dbs.add(self.raw_uri)
+
+    async def info(self):
+        """
+        Get database information
+        @return: dict
+        """
+        return await self.res.request("GET")
+
+    async def all_docs(self, **params):
+        """
+        return all_docs
+        """
+        return await self.view('_all_docs', **params)
+
+    async def open_doc(self, docid, **params):
+        """Open document from database
+
+        @param docid: str, document id to retrieve
+        @params params: Other params to pass to the uri
+
+        @return: dict, representation of CouchDB document as a dict.
+        """
+        return await self.res.request("GET", escape_docid(docid), **params)
+
+    async def save_doc(self, doc, force_update=False, **params):
+        """ Save a document. Without an ``_id`` it is POSTed and CouchDB
+        assigns it one.
+
+        @param doc: dict. doc is updated with doc '_id' and '_rev' properties
+        returned by CouchDB server when you save.
+        @param force_update: boolean, if there is conlict, try to update
+        with latest revision
+
+        @return: new doc with updated revision an id
+        """
+        headers = params.get('headers', {})
+        headers.setdefault('Content-Type', 'application/json')
+        params['headers'] = headers
+
+        if '_id' in doc:
+            docid = escape_docid(doc['_id'])
+            try:
+                resp = await self.res.request("PUT", docid,
+                                              payload=json.dumps(doc), **params)
+            except ResourceConflict:
+                if not force_update:
+                    raise
+                doc['_rev'] = await self.last_rev(doc['_id'])
+                resp = await self.res.request("PUT", docid,
+                                              payload=json.dumps(doc), **params)
+        else:
+            resp = await self.res.request("POST", payload=json.dumps(doc),
+                                          **params)
+
+        for a, n in list(aliases.items()):
+            if a in resp:
+                doc[n] = resp[a]
+        return doc
+
+    async def last_rev(self, docid):
+        """ Get last revision from docid (the '_rev' member)
+        @param docid: str, undecoded document id.
+
+        @return rev: str, the last revision of document.
+        """
+        revs = await self.get_revs([docid])
+        if docid not in revs:
+            raise ResourceNotFound("missing", http_code=404,
+                                   response="document %s not found" % docid)
+        return revs[docid]
+
+    async def get_revs(self, docids, chunk_size=1000):
+        """ Get the last revision of many documents, see
+        `client.Database.get_revs`.
+
+        @return: dict, docid -> rev. Missing and deleted documents
+        are left out.
+        """
+        docids = list(docids)
+        revs = {}
+        for i in range(0, len(docids), chunk_size):
+            resp = await self.all_docs(keys=docids[i:i + chunk_size])
+            for row in resp.get('rows', []):
+                value = row.get('value')
+                if 'error' in row or not value or value.get('deleted'):
+                    continue
+                revs[row['id']] = value['rev']
+        return revs
+
+    async def save_docs(self, docs, all_or_nothing=False,
+                        batch_size=BULK_BATCH_SIZE,
+                        batch_bytes=BULK_BATCH_BYTES, jobs=1, progress=None):
+        """ Bulk save, see `client.Database.save_docs`. Documents without an
+        ``_id`` get one from CouchDB.
+
+        @param jobs: number of requests in flight at the same time
+
+        @return doc lists updated with new revision or raise BulkSaveError
+        exception.
+        """
+        if all_or_nothing:
+            batch_size = batch_bytes = None
+            jobs = 1
+
+        async def post(batch):
+            indexes, body = batch
+            if all_or_nothing:
+                body = b'{"all_or_nothing":true,' + body[1:]
+            res = await self.res.request(
+                "POST", '_bulk_docs', payload=body,
+                headers={'Content-Type': 'application/json'})
+            return indexes, res
+
+        errors = []
+        done = 0
+
+        async def results(task):
+            nonlocal done
+            indexes, json_res = await task
+            done += len(indexes)
+            if progress is not None:
+                progress(done, len(docs))
+            return Database._bulk_results(docs, indexes, json_res)
+
+        # keep at most ``jobs`` serialized batches in memory
+        pending = deque()
+        try:
+            for batch in _bulk_batches(docs, batch_size, batch_bytes):
+                pending.append(asyncio.ensure_future(post(batch)))
+                if len(pending) >= max(jobs, 1):
+                    errors += await results(pending.popleft())
+            while pending:
+                errors += await results(pending.popleft())
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if errors:
+            raise BulkSaveError(docs, errors)
+
+    async def put_attachment(self, doc, content=None, name=None, headers=None,
+                             content_type=None):
+        """ Add attachement to a document, see
+        `client.Database.put_attachment`.
+
+        @return: updated document object, its ``_rev`` is taken from the
+        response.
+        """
+        headers = dict(headers or {})
+        content = content or b""
+        if content_type:
+            headers.setdefault('Content-Type', content_type)
+
+        if name is None:
+            if hasattr(content, "name"):
+                name = content.name
+            else:
+                raise InvalidAttachment('You should provid a valid ' +
+                                        'attachment name')
+        res = await self.res.request(
+            "PUT", "%s/%s" % (escape_docid(doc['_id']), quote(name, safe="")),
+            payload=content, headers=headers, rev=doc['_rev'])
+
+        if 'ok' in res:
+            doc['_rev'] = res['rev']
+            doc.setdefault('_attachments', {})[name] = {
+                'stub': True, 'content_type': headers.get('Content-Type')}
+            return doc
+        return False
+
+    async def view(self, view_name, **params):
+        method, path, params = _view_request(view_name, params)
+        return await self.res.request(method, path, **params)
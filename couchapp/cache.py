@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from couchapp import util
+
+logger = logging.getLogger(__name__)
+
+# relative to the app directory
+CACHE_DIR = os.path.join('.couchapp', 'cache')
+
+# files modified less than this many nanoseconds ago are hashed but not
+# cached: another write within the same mtime tick would go unnoticed.
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+
+def cache_dir(app_dir):
+    return os.path.join(app_dir, CACHE_DIR)
+
+
+def docs_cache_dir(app_dir, name):
+    """
+    Cache dir of the document ``_docs/<name>`` of an app, kept in the
+    cache dir of the app rather than in the document directory.
+    """
+    return os.path.join(cache_dir(app_dir), 'docs', name)
+
+
+def write_cache_file(path, content):
+    """
+    Atomically replace ``path`` with ``content`` (bytes), creating
+    the cache dir if needed. Errors are logged and ignored, a cache
+    that can't be written only costs some speed.
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.debug("can't write cache file %s: %s", path, e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+class SignatureCache(object):
+    """
+    Persistent cache of the attachment signatures of an app, stored in
+    ``.couchapp/cache/signatures.json`` or in ``directory``.
+
+    An entry is reused as long as the size, mtime and inode of the file
+    didn't change, otherwise the file is hashed again. Entries of files
+    which were not signed since the cache was loaded are dropped on
+    ``save()``. Each signature algorithm has its own entries.
+    """
+    FILENAME = 'signatures.json'
+    VERSION = 2
+
+    def __init__(self, app_dir, algorithm=util.DEFAULT_SIGNATURE_ALGORITHM,
+                 directory=None):
+        self.app_dir = app_dir
+        self.algorithm = algorithm
+        self.path = os.path.join(directory or cache_dir(app_dir),
+                                 self.FILENAME)
+        self._entries = self._load()
+        self._seen = set()
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            logger.debug("discard outdated signature cache %s", self.path)
+            return {}
+        return data.get('entries', {})
+
+    def sign(self, fpath, st=None):
+        """
+        Return the signature of ``fpath``, see ``util.sign``.
+
+        :param st: optional ``os.stat_result`` of ``fpath``
+        """
+        return self.sign_all([(fpath, st)])[0]
+
+    def sign_all(self, files, workers=1, processes=False):
+        """
+        Return the signatures of ``files``, a list of ``(filepath, stat)``,
+        in the same order. The files missing from the cache are hashed on
+        a pool of ``workers`` threads, or processes if ``processes``.
+        """
+        signatures = []
+        missing = []
+        for fpath, st in files:
+            signature, stamp = self._lookup(fpath, st)
+            signatures.append(signature)
+            if signature is None:
+                missing.append((len(signatures) - 1, fpath, stamp))
+
+        hashed = util.pool_map(functools.partial(util.sign,
+                                                 algorithm=self.algorithm),
+                               [fpath for _, fpath, _ in missing],
+                               workers=workers, processes=processes)
+        for (i, fpath, stamp), signature in zip(missing, hashed):
+            signatures[i] = signature
+            if stamp is not None:
+                self._store(fpath, stamp, signature)
+        return signatures
+
+    def _key(self, fpath):
+        prefix = self.app_dir + os.sep
+        if fpath.startswith(prefix):
+            path = fpath[len(prefix):]
+        else:
+            path = os.path.relpath(fpath, self.app_dir)
+        return '%s:%s' % (self.algorithm, path)
+
+    def _lookup(self, fpath, st=None):
+        """
+        :return: ``(signature, stamp)``, signature being None if ``fpath``
+            isn't in the cache, and stamp None if it can't be stat'ed
+        """
+        key = self._key(fpath)
+        try:
+            st = st or os.stat(fpath)
+        except OSError:
+            return None, None
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+
+        with self._lock:
+            self._seen.add(key)
+            entry = self._entries.get(key)
+        if entry is not None and entry[:3] == stamp:
+            return entry[3], stamp
+        return None, stamp
+
+    def _store(self, fpath, stamp, signature):
+        key = self._key(fpath)
+        racy = time.time_ns() - stamp[1] < RACY_WINDOW_NS
+        with self._lock:
+            if racy or not isinstance(signature, str):
+                self._dirty |= self._entries.pop(key, None) is not None
+            else:
+                self._entries[key] = stamp + [signature]
+                self._dirty = True
+
+    def save(self):
+        """
+        Drop the entries of the files that were not signed with this
+        algorithm and write the cache to disk if it changed.
+        """
+        prefix = self.algorithm + ':'
+        with self._lock:
+            for key in set(self._entries) - self._seen:
+                if key.startswith(prefix):
+                    del self._entries[key]
+                    self._dirty = True
+            if not self._dirty:
+                return
+            data = {'version': self.VERSION, 'entries': self._entries}
+            write_cache_file(self.path, json.dumps(data).encode('utf-8'))
+            self._dirty = False
+
+
+class TreeSignatureCache(SignatureCache):
+    """
+    ``SignatureCache`` of all the files of the app, from which
+    ``LocalDoc.tree_fingerprint`` is computed.
+    """
+    FILENAME = 'tree-signatures.json'
+
+
+class MacroCache(object):
+    """
+    Persistent dependency graph of the macro expansions of an app, stored
+    in ``.couchapp/cache/macros.json`` or in ``directory``.
+
+    Each function of the design document (``shows/foo``,
+    ``views/bar/map``...) is recorded with the hash of its source, the
+    files, glob patterns and document fields its ``!code`` and ``!json``
+    macros pulled in, and the expanded result. Entries of functions which
+    were not looked up since the cache was loaded are dropped on
+    ``save()``.
+    """
+    FILENAME = 'macros.json'
+    VERSION = 1
+
+    def __init__(self, app_dir, directory=None):
+        self.app_dir = app_dir
+        self.path = os.path.join(directory or cache_dir(app_dir),
+                                 self.FILENAME)
+        self._entries = self._load()
+        self._seen = set()
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            logger.debug("discard outdated macro cache %s", self.path)
+            return {}
+        return data.get('entries', {})
+
+    def get(self, name):
+        self._seen.add(name)
+        return self._entries.get(name)
+
+    def store(self, name, entry):
+        """
+        :param entry: dict with the ``source`` hash, ``files``
+            (relpath -> stamp), ``globs`` (pattern -> relpaths), ``fields``
+            (json source -> hash) and the expanded ``result``
+        """
+        self._seen.add(name)
+        if self._entries.get(name) != entry:
+            self._entries[name] = entry
+            self._dirty = True
+
+    def discard(self, name):
+        self._seen.add(name)
+        self._dirty |= self._entries.pop(name, None) is not None
+
+    def dependents(self, relpath):
+        """
+        Return the names of the functions including ``relpath``.
+        """
+        return sorted(name for name, entry in self._entries.items()
+                      if relpath in entry['files'])
+
+    def save(self):
+        for name in set(self._entries) - self._seen:
+            del self._entries[name]
+            self._dirty = True
+        if not self._dirty:
+            return
+        data = {'version': self.VERSION, 'entries': self._entries}
+        write_cache_file(self.path, json.dumps(data).encode('utf-8'))
+        self._dirty = False
+
+
+class BuildCache(object):
+    """
+    Content-addressed cache of exported documents, one
+    ``<key>.json`` file per build in ``path`` (by default
+    ``.couchapp/cache/builds``).
+
+    The key is meant to be ``LocalDoc.tree_fingerprint()``, so the cache
+    can be shared by fresh checkouts of the same tree. Once the entries
+    take more than ``max_size`` bytes, the least recently used ones are
+    removed.
+    """
+    DIRNAME = 'builds'
+    DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    @classmethod
+    def for_app(cls, app_dir, max_size=DEFAULT_MAX_SIZE):
+        return cls(os.path.join(cache_dir(app_dir), cls.DIRNAME), max_size)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        """
+        :return: the path of the file stored for ``key``, or None
+        """
+        path = self._entry(key)
+        try:
+            # the mtime orders the entries for the eviction
+            os.utime(path)
+        except OSError:
+            return None
+        logger.debug("build cache hit: %s", key)
+        return path
+
+    def put(self, key, chunks):
+        """
+        Store the content ``chunks`` (str) for ``key``, streamed to disk.
+
+        :return: the path of the stored file, or None if it can't be written
+        """
+        path = self._entry(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.debug("can't write cache file %s: %s", path, e)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return None
+        self.evict(keep=key)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries, but ``keep``, until they
+        fit in ``max_size``.
+        """
+        entries = []
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.name.endswith('.json') and \
+                            entry.name != '%s.json' % keep:
+                        st = entry.stat()
+                        entries.append((st.st_mtime_ns, st.st_size,
+                                        entry.path))
+        except OSError:
+            return
+
+        size = sum(e[1] for e in entries)
+        if keep is not None:
+            try:
+                size += os.stat(self._entry(keep)).st_size
+            except OSError:
+                pass
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            logger.debug("evict build %s", path)
+            size -= entry_size
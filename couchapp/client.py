@@ -5,15 +5,24 @@
 
 
 import base64
-import itertools
+import codecs
+import contextlib
 import json
 import logging
+import os
+import random
 import re
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from urllib.parse import quote
-from couchapp import __version__
+from urllib.parse import quote, urlsplit
+from couchapp import __version__, util
 from couchapp.errors import ResourceNotFound, ResourceConflict, \
     PreconditionFailed, RequestFailed, BulkSaveError, Unauthorized, \
     InvalidAttachment
@@ -27,8 +36,76 @@ aliases = {
 
 UNKNOWN_VERSION = tuple()
 
+# connection pool defaults, can be overridden through the ``http``
+# section of the couchapp configuration
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_KEEPALIVE = True
+
+# size of the blocks read from disk when streaming attachments
+CHUNK_SIZE = 64 * 1024
+
+# bytes of the response bodies logged at debug level
+LOG_BODY_LIMIT = 1024
+
+# max number of documents and bytes per ``_bulk_docs`` request
+BULK_BATCH_SIZE = 1000
+BULK_BATCH_BYTES = 8 * 1024 * 1024
+
 logger = logging.getLogger(__name__)
 
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# uris of the databases known to exist, shared by all the handles of the
+# process so that each database is probed or created once
+_existing_dbs = set()
+_existing_dbs_lock = threading.Lock()
+
+_uuids = {}
+_uuids_lock = threading.Lock()
+
+
+def get_session(uri, pool_size=DEFAULT_POOL_SIZE,
+                max_retries=DEFAULT_MAX_RETRIES, keepalive=DEFAULT_KEEPALIVE):
+    """
+    Return the pooled ``requests.Session`` shared by all the resources
+    pointing to the same server (scheme, host and port of ``uri``).
+
+    :param pool_size: int, max number of connections kept open to the server
+    :param max_retries: int, number of retries on connection errors and
+        on 502/503/504 responses
+    :param keepalive: bool, if False connections are closed after each request
+    """
+    parts = urlsplit(uri)
+    hostport = parts.netloc.rsplit('@', 1)[-1]
+    key = (parts.scheme, hostport, pool_size, max_retries, keepalive)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            retries = Retry(total=max_retries, read=0, backoff_factor=0.1,
+                            status_forcelist=(502, 503, 504),
+                            raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                  max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = USER_AGENT
+            if not keepalive:
+                session.headers['Connection'] = 'close'
+            _sessions[key] = session
+    return session
+
+
+def close_sessions():
+    """ close all the pooled connections """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
 
 class CouchdbResponse(requests.Response):
 
@@ -43,31 +120,101 @@ class CouchdbResponse(requests.Response):
         or raise an exception if it failed
         """
         if self.response.ok:
-            logger.debug("Response status_code: %s", self.response.status_code)
-            logger.debug("Response text: %s", self.response.text)
-            logger.debug("Response headers: %s", self.response.headers)
-            logger.debug("Response encoding: %s", self.response.encoding)
-            logger.debug("Response content: %s", self.response.content)
+            content = self.response.content
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response status_code: %s", self.response.status_code)
+                logger.debug("Response headers: %s", self.response.headers)
+                logger.debug("Response content: %s", truncate(content))
             self.response.close()
             try:
-                return self.response.json()
+                # bytes are decoded by json itself, without guessing the
+                # encoding from the whole body nor copying it to a str
+                return json.loads(content)
             except ValueError:
                 # No JSON object could be decoded
-                return self.response.content
-        else:
-            errorReason = self.response.reason
-            errorCode = self.response.status_code
-
-        if errorCode in (401, 403):
-            raise Unauthorized(str(self.response))
-        elif errorCode == 404:
-            raise ResourceNotFound(errorReason, http_code=errorCode, response=self.response.text)
-        elif errorCode == 409:
-            raise ResourceConflict(errorReason, http_code=errorCode, response=self.response.text)
-        elif errorCode == 412:
-            raise PreconditionFailed(errorReason, http_code=errorCode, response=self.response.text)
-        else:
-            raise RequestFailed(str(self.response))
+                return content
+        raise_for_status(self.response.status_code, self.response.reason,
+                         self.response.text, str(self.response))
+
+
+def truncate(content, limit=LOG_BODY_LIMIT):
+    """ shorten a response body to log it """
+    if len(content) <= limit:
+        return content
+    return content[:limit] + b'... (%d bytes)' % len(content)
+
+
+def raise_for_status(errorCode, errorReason, text, descr):
+    """
+    Raise the exception matching the HTTP error ``errorCode`` of a
+    CouchDB response.
+
+    :param text: body of the response
+    :param descr: description of the response
+    """
+    if errorCode in (401, 403):
+        raise Unauthorized(descr)
+    elif errorCode == 404:
+        raise ResourceNotFound(errorReason, http_code=errorCode, response=text)
+    elif errorCode == 409:
+        raise ResourceConflict(errorReason, http_code=errorCode, response=text)
+    elif errorCode == 412:
+        raise PreconditionFailed(errorReason, http_code=errorCode, response=text)
+    else:
+        raise RequestFailed(descr)
+
+
+class MultipartStream(object):
+    """
+    Body of a ``multipart/related`` request: a JSON document followed by
+    the attachments marked as ``follows``, in the order they appear in
+    ``doc['_attachments']``. Files are read by chunks while the body is
+    sent, and ``len()`` returns the size of the whole body, so requests
+    sends it with a ``Content-Length`` rather than chunked.
+    """
+
+    def __init__(self, doc, files, chunk_size=CHUNK_SIZE):
+        """
+        @param doc: dict, document with ``follows`` attachment stubs
+        @param files: dict, attachment name -> path of the file to send
+        """
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.doc = json.dumps(doc).encode('utf-8')
+        self.parts = [(name, files[name], att['length'])
+                      for name, att in doc['_attachments'].items()
+                      if att.get('follows')]
+
+    @property
+    def content_type(self):
+        return 'multipart/related; boundary="%s"' % self.boundary
+
+    def _delimiter(self, headers=b''):
+        return b'--' + self.boundary.encode('ascii') + b'\r\n' + headers + b'\r\n'
+
+    def __len__(self):
+        size = len(self._delimiter(b'Content-Type: application/json\r\n'))
+        size += len(self.doc) + 2
+        for name, filepath, length in self.parts:
+            size += len(self._delimiter()) + length + 2
+        return size + len(self.boundary) + 4
+
+    def __iter__(self):
+        yield self._delimiter(b'Content-Type: application/json\r\n')
+        yield self.doc + b'\r\n'
+        for name, filepath, length in self.parts:
+            yield self._delimiter()
+            with open(filepath, 'rb') as f:
+                remaining = length
+                while remaining:
+                    data = f.read(min(self.chunk_size, remaining))
+                    if not data:
+                        raise InvalidAttachment("%s changed while "
+                                                "uploading it" % filepath)
+                    remaining -= len(data)
+                    yield data
+            yield b'\r\n'
+        yield b'--' + self.boundary.encode('ascii') + b'--'
 
 
 class CouchdbResource(object):
@@ -78,12 +225,18 @@ class CouchdbResource(object):
         CouchdbResource represent an HTTP resource to CouchDB.
 
         @param uri: str, full uri to the server.
+        @param pool_size, max_retries, keepalive: connection pool
+            settings, see `get_session`.
         """
         self.uri = uri
         # FIXME: dangerous if the database name is not part of the URI
         # self.database = uri.rsplit("/", 1)[1]
         self.client_opts = client_opts
-        # requests.__init__(self, uri=uri, **client_opts)
+        self.session = get_session(
+            uri,
+            pool_size=client_opts.get('pool_size', DEFAULT_POOL_SIZE),
+            max_retries=client_opts.get('max_retries', DEFAULT_MAX_RETRIES),
+            keepalive=client_opts.get('keepalive', DEFAULT_KEEPALIVE))
         self.safe = ":/%"
 
     def copy(self, path=None, headers=None, **params):
@@ -91,7 +244,7 @@ class CouchdbResource(object):
         return self.request('COPY', path=path, headers=headers, **params)
 
     def request(self, method, path=None, payload=None, headers=None,
-                params_dict=None, **params):
+                params_dict=None, stream=False, **params):
         """ Perform HTTP call to the couchdb server and manage
         JSON conversions, support GET, POST, PUT and DELETE.
 
@@ -115,6 +268,10 @@ class CouchdbResource(object):
             Parameterss are for example the parameters for a view. See
             `CouchDB View API reference
             <http://wiki.apache.org/couchdb/HTTP_view_API>`_ for example.
+            Keys and values which aren't strings are encoded in JSON.
+        @param stream: If true, return the ``requests.Response`` once the
+            headers are received, its body is left to read (and the
+            response to close) by the caller.
 
         @return: tuple (data, resp), where resp is an `httplib2.Response`
             object and data a python object (often a dict).
@@ -125,28 +282,37 @@ class CouchdbResource(object):
             path = self.uri
         headers = headers or {}
         headers.setdefault('Accept', 'application/json')
-        headers.setdefault('User-Agent', USER_AGENT)
+        query = dict(params_dict or {})
+        query.update(params)
+        query = encode_params(query)
 
         logger.debug("Request: %s %s", method, path)
 
         try:
-            resp = requests.request(method, url=path, data=payload,
-                                    headers=headers, **params)
+            resp = self.session.request(method, url=path, data=payload,
+                                        headers=headers, params=query,
+                                        stream=stream)
         except Exception as e:
             logger.exception("Error making a CouchdbResource call. Details: %s", e)
             raise RequestFailed('unknown error [%s]', str(e))
+        if stream:
+            if not resp.ok:
+                with contextlib.closing(resp):
+                    raise_for_status(resp.status_code, resp.reason, resp.text,
+                                     str(resp))
+            return resp
         return CouchdbResponse(resp).json_body
 
 
-def couchdb_version(server_uri):
-    res = CouchdbResource(server_uri)
+def couchdb_version(server_uri, **client_opts):
+    res = CouchdbResource(server_uri, **client_opts)
 
     try:
         resp = res.request("GET")
     except Exception:
         return UNKNOWN_VERSION
 
-    version = CouchdbResponse(resp).json_body
+    version = resp.get('version', '')
     t = []
     for p in version.split("."):
         try:
@@ -158,18 +324,50 @@ def couchdb_version(server_uri):
 
 
 class Uuids(object):
+    """ Iterator of document ids.
+
+    The ids are fetched from the ``_uuids`` of the server by batches of
+    ``max_uuids`` into a deque, which is refilled in a background thread
+    once fewer than ``low_water`` ids are left, so that taking an id
+    seldom waits for a request.
+
+    With ``sequential=True`` the ids are generated locally like the
+    ``sequential`` algorithm of CouchDB: a random prefix of 26 hex digits
+    followed by a 6 hex digits suffix increased by a random step, the
+    prefix being drawn again when the suffix overflows. Ids inserted in
+    that order keep the database b-tree compact.
+    """
 
-    def __init__(self, uri, max_uuids=1000, **client_opts):
+    def __init__(self, uri, max_uuids=1000, low_water=None,
+                 sequential=False, **client_opts):
         api = "_uuids"
         uri = "{}/{}".format(uri, api)
         self.res = CouchdbResource(uri=uri, **client_opts)
-        self._uuids = []
+        self._uuids = deque()
         self.max_uuids = max_uuids
+        self.low_water = max_uuids // 4 if low_water is None else low_water
+        self.sequential = sequential
+        self._lock = threading.Lock()
+        self._refill = None
+        self._prefix = None
+        self._seq = 0
 
     def __next__(self):
-        if not self._uuids:
-            self.fetch_uuids()
-        self._uuids, res = self._uuids[:-1], self._uuids[-1]
+        if self.sequential:
+            return self._next_sequential()
+
+        while True:
+            try:
+                res = self._uuids.popleft()
+                break
+            except IndexError:
+                refill = self._refill
+                if refill is not None:
+                    refill.join()
+                if not self._uuids:
+                    self.fetch_uuids()
+        if len(self._uuids) < self.low_water:
+            self._start_refill()
         return res
 
     def __iter__(self):
@@ -177,34 +375,119 @@ class Uuids(object):
 
     def fetch_uuids(self):
         count = self.max_uuids - len(self._uuids)
+        if count <= 0:
+            return
         resp = self.res.request("GET", count=count)
-        self._uuids += resp.json_body['uuids']
+        self._uuids.extend(resp['uuids'])
+
+    def _start_refill(self):
+        with self._lock:
+            if self._refill is not None and self._refill.is_alive():
+                return
+            self._refill = threading.Thread(target=self._background_fetch,
+                                            daemon=True)
+            self._refill.start()
+
+    def _background_fetch(self):
+        try:
+            self.fetch_uuids()
+        except Exception as e:
+            # fetched again when the deque is empty, raising then
+            logger.debug("can't prefetch uuids: %s", e)
+
+    def _next_sequential(self):
+        with self._lock:
+            if self._prefix is None or self._seq >= 0xfff000:
+                self._prefix = os.urandom(13).hex()
+                self._seq = 0
+            self._seq += random.randint(1, 0xffe)
+            return '%s%06x' % (self._prefix, self._seq)
+
+
+def get_uuids(server_uri, **client_opts):
+    """
+    Return the `Uuids` shared by all the databases of ``server_uri`` having
+    the same ``client_opts``. ``sequential_uuids=True`` in ``client_opts``
+    makes them generated locally.
+    """
+    key = (server_uri, tuple(sorted(client_opts.items())))
+    with _uuids_lock:
+        uuids = _uuids.get(key)
+        if uuids is None:
+            uuids = Uuids(server_uri,
+                          sequential=client_opts.get('sequential_uuids', False),
+                          **client_opts)
+            _uuids[key] = uuids
+    return uuids
+
+
+def create_dbs(dbs, jobs=1):
+    """
+    Create the databases of ``dbs`` (`Database`) not known to exist yet,
+    running at most ``jobs`` requests at the same time.
+
+    @return: list of ``(db, error)`` of the databases which couldn't be
+        created, a failing database doesn't stop the others.
+    """
+    missing = [db for db in dbs if db.raw_uri not in _existing_dbs]
+    return [(db, error) for db, _, error in
+            util.run_parallel(lambda db: db.ensure_exists(), missing, jobs)
+            if error is not None]
 
 
 class Database(object):
     """ Object that abstract access to a CouchDB database
     A Database object can act as a Dict object.
+
+    With ``create=True`` the database is created if it doesn't exist, once
+    per process. With ``lazy=True`` this is deferred until the first write,
+    so that handles which are never written to cost no request.
+
+    With ``sequential_uuids=True`` in ``client_opts``, the ids of new
+    documents are generated locally, see `Uuids`.
     """
 
-    def __init__(self, uri, create=True, **client_opts):
+    def __init__(self, uri, create=True, lazy=False, **client_opts):
         if uri.endswith("/"):
             uri = uri[:-1]
 
         self.raw_uri = uri
         self.res = CouchdbResource(uri=uri, **client_opts)
         self.server_uri, self.dbname = uri.rsplit('/', 1)
+        self.client_opts = client_opts
+        self.create = create
 
-        self.uuids = Uuids(self.server_uri, **client_opts)
+        if create and not lazy:
+            self.ensure_exists()
 
-        if create:
-            # create the db
+    @property
+    def uuids(self):
+        """ the `Uuids` shared by the databases of the server """
+        return get_uuids(self.server_uri, **self.client_opts)
+
+    def ensure_exists(self):
+        """ create the database unless it is known to exist """
+        if self.raw_uri in _existing_dbs:
+            return
+        try:
+            self.res.request("HEAD")
+        except ResourceNotFound:
             try:
-                self.res.request("HEAD")
-            except ResourceNotFound:
                 self.res.request("PUT")
+            except PreconditionFailed:
+                # created by someone else in the meantime
+                pass
+        with _existing_dbs_lock:
+            _existing_dbs.add(self.raw_uri)
+
+    def _before_write(self):
+        if self.create:
+            self.ensure_exists()
 
     def delete(self):
         self.res.request("DELETE")
+        with _existing_dbs_lock:
+            _existing_dbs.discard(self.raw_uri)
 
     def info(self):
         """
@@ -258,6 +541,7 @@ class Database(object):
 
         @return: new doc with updated revision an id
         """
+        self._before_write()
         if '_attachments' in doc and encode:
             doc['_attachments'] = encode_attachments(doc['_attachments'])
 
@@ -291,19 +575,80 @@ class Database(object):
         doc.update(doc1)
         return doc
 
+    def save_doc_multipart(self, doc, attachments, force_update=False):
+        """ Save a document and upload some of its attachments in a single
+        streamed ``multipart/related`` request, instead of embedding them in
+        the JSON document as base64. Memory usage doesn't depend on the size
+        of the attachments.
+
+        @param doc: dict, document with an ``_id``. Attachments already in
+        ``doc['_attachments']`` are sent as is (usually stubs).
+        @param attachments: list of ``(name, filepath, content_type)``
+        @param force_update: boolean, if there is conlict, try to update
+        with latest revision
+
+        @return: new doc with updated revision
+        """
+        self._before_write()
+        doc['_attachments'] = dict(doc.get('_attachments') or {})
+        files = {}
+        for name, filepath, content_type in attachments:
+            doc['_attachments'][name] = {
+                'follows': True,
+                'content_type': content_type or 'application/octet-stream',
+                'length': os.path.getsize(filepath)}
+            files[name] = filepath
+
+        docid = escape_docid(doc['_id'])
+        body = MultipartStream(doc, files)
+        try:
+            resp = self.res.request("PUT", docid, payload=body,
+                                    headers={'Content-Type': body.content_type})
+        except ResourceConflict:
+            if not force_update:
+                raise
+            doc['_rev'] = self.last_rev(doc['_id'])
+            body = MultipartStream(doc, files)
+            resp = self.res.request("PUT", docid, payload=body,
+                                    headers={'Content-Type': body.content_type})
+
+        for name in files:
+            doc['_attachments'][name] = {'stub': True}
+        doc.update({'_id': resp['id'], '_rev': resp['rev']})
+        return doc
+
     def last_rev(self, docid):
         """ Get last revision from docid (the '_rev' member)
         @param docid: str, undecoded document id.
 
         @return rev: str, the last revision of document.
         """
-        r = self.res.request("HEAD", escape_docid(docid))
-        if "etag" in r.headers:
-            # yeah new couchdb handle that
-            return r.headers['etag'].strip('"')
-        # old way ..
-        doc = self.open_doc(docid)
-        return doc['_rev']
+        revs = self.get_revs([docid])
+        if docid not in revs:
+            raise ResourceNotFound("missing", http_code=404,
+                                   response="document %s not found" % docid)
+        return revs[docid]
+
+    def get_revs(self, docids, chunk_size=1000):
+        """ Get the last revision of many documents with
+        ``POST _all_docs {"keys": [...]}`` requests of at most
+        ``chunk_size`` ids, instead of one request per document.
+
+        @param docids: list of undecoded document ids
+
+        @return: dict, docid -> rev. Missing and deleted documents
+        are left out.
+        """
+        docids = list(docids)
+        revs = {}
+        for i in range(0, len(docids), chunk_size):
+            resp = self.all_docs(keys=docids[i:i + chunk_size])
+            for row in resp.get('rows', []):
+                value = row.get('value')
+                if 'error' in row or not value or value.get('deleted'):
+                    continue
+                revs[row['id']] = value['rev']
+        return revs
 
     def delete_doc(self, id_or_doc):
         """ Delete a document
@@ -321,58 +666,91 @@ class Database(object):
             resp = self.res.request("DELETE", escape_docid(docid), rev=rev)
         return resp
 
-    def save_docs(self, docs, all_or_nothing=False, use_uuids=True):
+    def save_docs(self, docs, all_or_nothing=False, use_uuids=True,
+                  batch_size=BULK_BATCH_SIZE, batch_bytes=BULK_BATCH_BYTES,
+                  jobs=1, progress=None):
         """ Bulk save. Modify Multiple Documents With a Single Request
 
+        Documents are serialized one by one and sent in batches of at most
+        ``batch_size`` documents and ``batch_bytes`` bytes, so the request
+        bodies stay small whatever the number of documents.
+
         @param docs: list of docs
         @param use_uuids: add _id in doc who don't have it already set.
         @param all_or_nothing: In the case of a power failure, when the
         database restarts either all the changes will have been saved or none
         of them. However, it does not do conflict checking, so the documents
-        will.
-
+        will. All the documents are sent in a single request.
+        @param batch_size: max number of documents per request
+        @param batch_bytes: max size of a request body, a bigger document
+        is sent alone
+        @param jobs: number of requests in flight at the same time
+        @param progress: callable called with the number of documents
+        processed so far and the total, after each request
 
         @return doc lists updated with new revision or raise BulkSaveError
         exception. You can access to doc created and docs in error as
         properties of this exception.
         """
-
-        def is_id(doc):
-            return '_id' in doc
-
+        self._before_write()
         if use_uuids:
-            noids = []
-            for k, g in itertools.groupby(docs, is_id):
-                if not k:
-                    noids = list(g)
-
-            for doc in noids:
-                nextid = next(self.uuids)
-                if nextid:
-                    doc['_id'] = nextid
+            for doc in docs:
+                if '_id' not in doc:
+                    nextid = next(self.uuids)
+                    if nextid:
+                        doc['_id'] = nextid
 
-        payload = {"docs": docs}
         if all_or_nothing:
-            payload["all-or-nothing"] = True
+            batch_size = batch_bytes = None
+            jobs = 1
 
-        # update docs
-        res = self.res.request("POST", '/_bulk_docs', payload=json.dumps(payload),
-                               headers={'Content-Type': 'application/json'})
+        def post(batch):
+            indexes, body = batch
+            if all_or_nothing:
+                body = b'{"all_or_nothing":true,' + body[1:]
+            res = self.res.request("POST", '_bulk_docs', payload=body,
+                                   headers={'Content-Type': 'application/json'})
+            return indexes, res
 
-        json_res = res
         errors = []
-        for i, r in enumerate(json_res):
+        done = 0
+
+        def results(future):
+            nonlocal done
+            indexes, json_res = future.result()
+            done += len(indexes)
+            if progress is not None:
+                progress(done, len(docs))
+            return self._bulk_results(docs, indexes, json_res)
+
+        batches = _bulk_batches(docs, batch_size, batch_bytes)
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            # keep at most ``jobs`` serialized batches in memory
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(post, batch))
+                if len(pending) >= jobs:
+                    errors += results(pending.popleft())
+            while pending:
+                errors += results(pending.popleft())
+
+        if errors:
+            raise BulkSaveError(docs, errors)
+
+    @staticmethod
+    def _bulk_results(docs, indexes, json_res):
+        """ update ``docs`` with the response of a ``_bulk_docs`` request,
+        return the documents in error """
+        errors = []
+        for i, r in zip(indexes, json_res):
             if 'error' in r:
                 doc1 = docs[i]
-                doc1.update({'_id': r['id'],
-                             '_rev': r['rev']})
+                doc1.update({'_id': r['id']})
                 errors.append(doc1)
             else:
                 docs[i].update({'_id': r['id'],
                                 '_rev': r['rev']})
-
-        if errors:
-            raise BulkSaveError(docs, errors)
+        return errors
 
     def delete_docs(self, docs, all_or_nothing=False, use_uuids=True):
         """ multiple doc delete."""
@@ -398,19 +776,30 @@ class Database(object):
         return self.res.request("GET", "%s/%s" % (escape_docid(docid), name),
                                 headers=headers)
 
-    def put_attachment(self, doc, content=None, name=None, headers=None):
-        """ Add attachement to a document. All attachments are streamed.
+    def put_attachment(self, doc, content=None, name=None, headers=None,
+                       content_type=None):
+        """ Add attachement to a document. All attachments are streamed,
+        open files in binary mode.
 
         @param doc: dict, document object
         @param content: string, iterator,  fileobj
         @param name: name or attachment (file name).
         @param headers: optionnal headers like `Content-Length`
         or `Content-Type`
+        @param content_type: content type of the attachment
 
-        @return: updated document object
+        @return: updated document object, its ``_rev`` is taken from the
+        response so there is no need to fetch the document again.
         """
-        headers = {}
+        self._before_write()
+        headers = dict(headers or {})
         content = content or ""
+        if content_type:
+            headers.setdefault('Content-Type', content_type)
+        if not isinstance(content, (str, bytes)) and \
+                requests.utils.super_len(content) == 0:
+            # avoid a chunked upload of an empty file
+            content = b""
 
         if name is None:
             if hasattr(content, "name"):
@@ -418,13 +807,16 @@ class Database(object):
             else:
                 raise InvalidAttachment('You should provid a valid ' +
                                         'attachment name')
-        name = quote(name, safe="")
-        res = self.res.request("PUT", "%s/%s" % (escape_docid(doc['_id']), name),
+        res = self.res.request("PUT", "%s/%s" % (escape_docid(doc['_id']),
+                                                 quote(name, safe="")),
                                payload=content, headers=headers, rev=doc['_rev'])
         json_res = res
 
         if 'ok' in json_res:
-            return doc.update(self.open_doc(doc['_id']))
+            doc['_rev'] = json_res['rev']
+            doc.setdefault('_attachments', {})[name] = {
+                'stub': True, 'content_type': headers.get('Content-Type')}
+            return doc
         return False
 
     def delete_attachment(self, doc, name):
@@ -435,23 +827,166 @@ class Database(object):
 
         @return: updated document object
         """
-        name = quote(name, safe="")
-        self.res.request("DELETE", "%s/%s" % (escape_docid(doc['_id']), name),
-                         rev=doc['_rev'])
-        return doc.update(self.open_doc(doc['_id']))
+        res = self.res.request("DELETE", "%s/%s" % (escape_docid(doc['_id']),
+                                                    quote(name, safe="")),
+                               rev=doc['_rev'])
+        doc['_rev'] = res['rev']
+        (doc.get('_attachments') or {}).pop(name, None)
+        return doc
 
     def view(self, view_name, **params):
+        method, path, params = _view_request(view_name, params)
+        return self.res.request(method, path, **params)
+
+    def iter_view(self, view_name, chunk_size=CHUNK_SIZE, **params):
+        """ Same as ``view``, but yield the rows one by one while the
+        response is read from the socket, so the memory used doesn't depend
+        on the number of rows.
+        """
+        method, path, params = _view_request(view_name, params)
+        resp = self.res.request(method, path, stream=True, **params)
+        with contextlib.closing(resp):
+            for row in iter_rows(resp.iter_content(chunk_size)):
+                yield row
+
+    def iter_all_docs(self, **params):
+        """ rows of all_docs, see ``iter_view`` """
+        return self.iter_view('_all_docs', **params)
+
+    def paginate_view(self, view_name, page_size=1000, prefetch=True,
+                      **params):
+        """ Yield all the rows of a view, fetched by pages of ``page_size``
+        rows so that at most two pages are held in memory. Each request
+        asks for one more row, whose key (and docid) is the ``startkey``
+        (and ``startkey_docid``) of the next page.
+
+        @param prefetch: bool, fetch the next page in a background thread
+            while the rows of the current one are consumed
+        @param params: view parameters, ``limit`` caps the number of
+            rows yielded. ``keys`` and ``skip`` can't be paged.
+        """
+        if 'keys' in params or 'skip' in params:
+            raise ValueError("can't paginate a view queried by keys or skip")
+        if page_size < 1:
+            raise ValueError("page_size must be positive")
+        remaining = params.pop('limit', None)
+
+        def fetch(query):
+            return self.view(view_name, limit=page_size + 1, **query)['rows']
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        pending = None
+        query = params
         try:
-            dname, vname = view_name.split("/")
-            path = "/_design/%s/_view/%s" % (dname, vname)
-        except ValueError:
-            path = view_name
+            rows = fetch(query)
+            while True:
+                page, more = rows[:page_size], rows[page_size:]
+                if remaining is not None:
+                    page = page[:remaining]
+                    remaining -= len(page)
+                    more = more if remaining else []
+                if more:
+                    query = dict(params, startkey=more[0]['key'])
+                    query.pop('start_key', None)
+                    query.pop('start_key_doc_id', None)
+                    if 'id' in more[0]:
+                        query['startkey_docid'] = more[0]['id']
+                    if executor is not None:
+                        pending = executor.submit(fetch, query)
+
+                for row in page:
+                    yield row
+                if not more:
+                    return
+                rows = pending.result() if pending is not None \
+                    else fetch(query)
+                pending = None
+        finally:
+            if executor is not None:
+                if pending is not None:
+                    pending.cancel()
+                executor.shutdown(wait=False)
+
+    def paginate_all_docs(self, **params):
+        """ rows of all_docs, see ``paginate_view`` """
+        return self.paginate_view('_all_docs', **params)
+
+
+def _view_request(view_name, params):
+    """ return the method, path and request parameters of a view query,
+    ``keys`` being POSTed """
+    try:
+        dname, vname = view_name.split("/")
+        path = "_design/%s/_view/%s" % (dname, vname)
+    except ValueError:
+        path = view_name
 
-        if "keys" in params:
-            keys = params.pop("keys")
-            return self.res.request("POST", path, json.dumps({"keys": keys}, **params))
+    params = dict(params)
+    if "keys" in params:
+        keys = params.pop("keys")
+        params.update(payload=json.dumps({"keys": keys}),
+                      headers={'Content-Type': 'application/json'})
+        return "POST", path, params
+    return "GET", path, params
 
-        return self.res.request("GET", path, **params)
+
+_ROWS_START = re.compile(r'"rows"\s*:\s*\[')
+
+
+def iter_rows(chunks):
+    """ yield the rows of a view response whose body arrives by ``chunks``
+    (bytes), decoding them one at a time. Only the current row and the
+    unparsed end of the last chunk are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf, pos, in_rows = '', 0, False
+    while True:
+        if not in_rows:
+            match = _ROWS_START.search(buf)
+            if match is not None:
+                in_rows, pos = True, match.end()
+                continue
+        else:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf):
+                if buf[pos] == ']':
+                    return
+                try:
+                    row, pos = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # the row isn't complete yet
+                    pass
+                else:
+                    yield row
+                    continue
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("truncated view response")
+        if in_rows:
+            buf, pos = buf[pos:], 0
+        buf += text.decode(chunk)
+
+
+def _bulk_batches(docs, batch_size=None, batch_bytes=None):
+    """ serialize ``docs`` one by one and group them in ``_bulk_docs``
+    bodies. Yield ``(indexes, body)``, ``indexes`` being the positions in
+    ``docs`` of the documents in ``body``. """
+    indexes, parts, size = [], [], 0
+    for i, doc in enumerate(docs):
+        part = json.dumps(doc).encode('utf-8')
+        if parts and ((batch_size and len(parts) >= batch_size) or
+                      (batch_bytes and size + len(part) > batch_bytes)):
+            yield indexes, b'{"docs":[' + b','.join(parts) + b']}'
+            indexes, parts, size = [], [], 0
+        indexes.append(i)
+        parts.append(part)
+        size += len(part) + 1
+    if parts:
+        yield indexes, b'{"docs":[' + b','.join(parts) + b']}'
 
 
 def encode_params(params):
@@ -461,9 +996,9 @@ def encode_params(params):
         for name, value in list(params.items()):
             if value is None:
                 continue
-            if name in ('key', 'startkey', 'endkey') \
+            if name in ('key', 'startkey', 'endkey', 'start_key', 'end_key') \
                     or not isinstance(value, str):
-                value = json.dumps(value).encode('utf-8')
+                value = json.dumps(value)
             _params[name] = value
     return _params
 
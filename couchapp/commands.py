@@ -6,15 +6,18 @@
 
 
 import argparse
+import asyncio
 import logging
 import os
 import sys
+import time
 
 from couchapp import __version__
-from couchapp import util
+from couchapp import aioclient, client, util, watch as watcher
+from couchapp.cache import BuildCache, MacroCache, docs_cache_dir
 from couchapp.config import Config
-from couchapp.errors import ResourceNotFound, BulkSaveError
-from couchapp.localdoc import document
+from couchapp.errors import AppError, BulkSaveError
+from couchapp.localdoc import DEFAULT_ASYNC_JOBS, document, is_attachment
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +36,10 @@ def push(path_app, url_dest, opts=None):
     :param path_app: string with the absolute path to the CouchApp source code
     :param url_dest: string with the CouchDB URL and database name destination
     :param opts: an argparse.Namespace object in the following format:
-        Namespace(export=False, force=False, no_atomic=False, output='blah', version=True)
+        Namespace(export=False, force=False, no_atomic=False, output='blah', version=True,
+                  jobs=1, multipart=False, split_views=False, workers=1,
+                  processes=False, signature_algorithm='md5', build_cache=None,
+                  no_build_cache=False, asyncio=False)
     """
     browse = False  # FIXME: deprecated! It must be removed
     if opts:
@@ -41,8 +47,25 @@ def push(path_app, url_dest, opts=None):
         output_file = opts.output
         noatomic = opts.no_atomic
         force = opts.force
+        jobs = getattr(opts, 'jobs', None)
+        multipart = getattr(opts, 'multipart', False)
+        split_views = getattr(opts, 'split_views', False)
+        workers = getattr(opts, 'workers', 1)
+        processes = getattr(opts, 'processes', False)
+        algorithm = getattr(opts, 'signature_algorithm', util.DEFAULT_SIGNATURE_ALGORITHM)
+        # only the command line enables the build cache by default
+        build_cache = not getattr(opts, 'no_build_cache', True)
+        build_cache_dir = getattr(opts, 'build_cache', None)
+        aio = getattr(opts, 'asyncio', False)
+        if jobs is None:
+            jobs = DEFAULT_ASYNC_JOBS if aio else 1
     else:
         export, output_file, noatomic, force = False, None, False, False
+        jobs, multipart, split_views = 1, False, False
+        workers, processes = 1, False
+        algorithm = util.DEFAULT_SIGNATURE_ALGORITHM
+        build_cache, build_cache_dir = False, None
+        aio = False
 
     app_name = path_app.rsplit("/", 1)[1]
     safe_url = util.sanitizeURL(url_dest)['url']
@@ -52,30 +75,102 @@ def push(path_app, url_dest, opts=None):
     couchapp_config = Config()
     couchapp_config.update(path_app)
 
-    doc = document(path_app, create=False)
+    doc = document(path_app, create=False, workers=workers, processes=processes,
+                   signature_algorithm=algorithm)
 
     if export:
-        if output_file:
-            util.write_json(output_file, doc)
-        else:
-            print(doc.to_json())
+        chunks = None
+        if build_cache:
+            # reuse the export of an identical tree
+            if build_cache_dir:
+                builds = BuildCache(build_cache_dir)
+            else:
+                builds = BuildCache.for_app(path_app)
+            key = doc.tree_fingerprint()
+            cached = builds.get(key) or builds.put(key, doc.iter_json())
+            if cached:
+                chunks = util.iter_file(cached)
+        util.write_chunks(output_file, chunks or doc.iter_json())
         return 0
 
-    dbs = couchapp_config.get_dbs(url_dest)
+    if aio:
+        if aioclient.aiohttp is None:
+            raise AppError("--asyncio requires the aiohttp package")
+        if multipart or split_views:
+            logger.warning("--multipart and --split-views are ignored "
+                           "with --asyncio")
+        asyncio.run(_push_async(couchapp_config, doc, url_dest, noatomic, force,
+                                jobs))
+    else:
+        dbs = couchapp_config.get_dbs(url_dest)
+        failed = client.create_dbs(dbs, jobs)
+        for db, error in failed:
+            logger.error("%s: can't create the database: %s",
+                         util.sanitizeURL(db.raw_uri)['url'], error)
+        failed_dbs = [db for db, _ in failed]
+        dbs = [db for db in dbs if db not in failed_dbs]
 
-    hook(couchapp_config, path_app, "pre-push", dbs=dbs)
-    doc.push(dbs, noatomic, browse, force)
-    hook(couchapp_config, path_app, "post-push", dbs=dbs)
+        if dbs:
+            hook(couchapp_config, path_app, "pre-push", dbs=dbs)
+            doc.push(dbs, noatomic, browse, force, jobs=jobs,
+                     multipart=multipart, split_views=split_views)
+            hook(couchapp_config, path_app, "post-push", dbs=dbs)
+        if failed:
+            raise failed[0][1]
 
     docspath = os.path.join(path_app, '_docs')
     if os.path.exists(docspath):
-        pushdocs(couchapp_config, docspath, url_dest, export, noatomic, browse, output_file)
+        pushdocs(couchapp_config, docspath, url_dest, export, noatomic, browse, output_file,
+                 jobs=jobs)
     return 0
 
 
-def pushdocs(conf, source, dest, export, noatomic, browse, output_file):
+async def _push_async(conf, doc, url_dest, noatomic=False, force=False,
+                      jobs=DEFAULT_ASYNC_JOBS):
+    """
+    Push ``doc`` with the asyncio client, creating the databases first.
+    """
+    dbs = conf.get_dbs(url_dest, aio=True)
+    try:
+        semaphore = asyncio.Semaphore(jobs)
+
+        async def create(db):
+            async with semaphore:
+                await db.create()
+
+        # like push_async, a database which can't be created doesn't stop
+        # the others, the first error is raised once they are all done
+        results = await asyncio.gather(*[create(db) for db in dbs],
+                                       return_exceptions=True)
+        errors = []
+        for db, result in zip(dbs, results):
+            if isinstance(result, Exception):
+                logger.error("%s: can't create the database: %s",
+                             util.sanitizeURL(db.raw_uri)['url'], result)
+                errors.append(result)
+        dbs = [db for db, result in zip(dbs, results)
+               if not isinstance(result, Exception)]
+
+        if dbs:
+            hook(conf, doc.docdir, "pre-push", dbs=dbs)
+            try:
+                await doc.push_async(dbs, noatomic, force, jobs=jobs)
+            except Exception as e:
+                errors.append(e)
+            else:
+                hook(conf, doc.docdir, "post-push", dbs=dbs)
+        if errors:
+            raise errors[0]
+    finally:
+        await aioclient.close_sessions()
+
+
+def pushdocs(conf, source, dest, export, noatomic, browse, output_file, jobs=1):
+    if not os.path.isdir(source):
+        return 0
     dbs = conf.get_dbs(dest)
     docs = []
+    uploads = []
     for d in os.listdir(source):
         docdir = os.path.join(source, d)
         if d.startswith('.'):
@@ -89,57 +184,214 @@ def pushdocs(conf, source, dest, export, noatomic, browse, output_file):
                 if export or not noatomic:
                     docs.append(doc)
                 else:
-                    for db in dbs:
-                        db.save_doc(doc, force_update=True)
+                    uploads.append(doc)
         else:
-            doc = document(docdir, is_ddoc=False)
+            # the caches go to the app's .couchapp, not to the document
+            doc = document(docdir, is_ddoc=False,
+                           cache_dir=docs_cache_dir(os.path.dirname(source), d))
             if export or not noatomic:
                 docs.append(doc)
             else:
-                doc.push(dbs, True, browse)
-    if docs:
-        if export:
-            docs1 = []
-            for doc in docs:
-                if hasattr(doc, 'doc'):
-                    docs1.append(doc.doc())
-                else:
-                    docs1.append(doc)
-            jsonobj = {'docs': docs}
-            if output_file:
-                util.write_json(output_file, jsonobj)
+                uploads.append(doc)
+    if export:
+        if docs:
+            util.write_chunks(output_file, _iter_docs_json(docs))
+        return 0
+    if not docs and not uploads:
+        return 0
+
+    # build the documents once, before the targets share them
+    for doc in docs + uploads:
+        if hasattr(doc, 'build'):
+            doc.build()
+
+    # the new targets are created concurrently, a failing one is only
+    # reported
+    errors = {}
+    for db, _, error in util.run_parallel(lambda db: db.ensure_exists(), dbs,
+                                          jobs):
+        if error is not None:
+            errors[db] = error
+
+    if uploads:
+        # attachments of a document are uploaded one by one, but
+        # several documents and targets are handled at the same time
+        def upload(item):
+            db, doc = item
+            if hasattr(doc, 'push'):
+                doc.push([db], True, browse)
             else:
-                print(util.json.dumps(jsonobj))
+                db.save_doc(doc.copy(), force_update=True)
+
+        items = [(db, doc) for db in dbs if db not in errors
+                 for doc in uploads]
+        for (db, doc), _, error in util.run_parallel(upload, items, jobs):
+            if error is not None:
+                errors.setdefault(db, error)
+    if docs:
+        # the targets are saved to concurrently, a failing target doesn't
+        # stop the others
+        targets = [db for db in dbs if db not in errors]
+        results = util.run_parallel(lambda db: _pushdocs_db(db, docs),
+                                    targets, jobs)
+        for db, _, error in results:
+            if error is not None:
+                errors[db] = error
+
+    for db in dbs:
+        url = util.sanitizeURL(db.raw_uri)['url']
+        if db in errors:
+            logger.error("%s: push of _docs failed: %s", url, errors[db])
         else:
-            for db in dbs:
-                docs1 = []
-                for doc in docs:
-                    if hasattr(doc, 'doc'):
-                        docs1.append(doc.doc(db))
-                    else:
-                        newdoc = doc.copy()
-                        try:
-                            rev = db.last_rev(doc['_id'])
-                            newdoc.update({'_rev': rev})
-                        except ResourceNotFound:
-                            pass
-                        docs1.append(newdoc)
-                try:
-                    db.save_docs(docs1)
-                except BulkSaveError as e:
-                    # resolve conflicts
-                    docs1 = []
-                    for doc in e.errors:
-                        try:
-                            doc['_rev'] = db.last_rev(doc['_id'])
-                            docs1.append(doc)
-                        except ResourceNotFound:
-                            pass
-                if docs1:
-                    db.save_docs(docs1)
+            logger.info("%s: pushed %d documents from _docs", url,
+                        len(docs) + len(uploads))
+    if errors:
+        raise next(iter(errors.values()))
     return 0
 
 
+def _pushdocs_db(db, docs):
+    """
+    Save ``docs`` (dicts or ``LocalDoc``) in ``db`` with ``_bulk_docs``,
+    retrying once the conflicting ones with their current revision.
+    """
+    url = util.sanitizeURL(db.raw_uri)['url']
+    docs1 = []
+    revs = db.get_revs(doc['_id'] for doc in docs
+                       if not hasattr(doc, 'doc'))
+    for doc in docs:
+        if hasattr(doc, 'doc'):
+            docs1.append(doc.doc(db))
+        else:
+            newdoc = doc.copy()
+            if doc['_id'] in revs:
+                newdoc.update({'_rev': revs[doc['_id']]})
+            docs1.append(newdoc)
+
+    def progress(done, total):
+        if done < total:
+            logger.info("%s: %d/%d documents saved", url, done, total)
+
+    try:
+        db.save_docs(docs1, progress=progress)
+    except BulkSaveError as e:
+        # resolve conflicts
+        revs = db.get_revs(doc['_id'] for doc in e.errors)
+        docs1 = []
+        for doc in e.errors:
+            if doc['_id'] in revs:
+                doc['_rev'] = revs[doc['_id']]
+                docs1.append(doc)
+        if docs1:
+            db.save_docs(docs1)
+
+
+def watch(path_app, url_dest, opts=None):
+    """
+    Push the CouchApp, then watch its directory and push the changes as
+    they happen, until interrupted.
+
+    A burst of changes is debounced and handled once. The document is
+    rebuilt from the signature and macro caches, so only the changed
+    attachments are hashed and only the functions including a changed file
+    are expanded again. Changed attachments are then uploaded one by one,
+    like ``--no-atomic``, otherwise only the document is saved.
+
+    :param opts: same as ``push``, plus ``debounce`` (seconds) and ``poll``
+        (don't use inotify)
+    """
+    push(path_app, url_dest, opts)
+    if opts is not None and opts.export:
+        return 0
+
+    jobs = getattr(opts, 'jobs', None) or 1
+    split_views = getattr(opts, 'split_views', False)
+    noatomic = getattr(opts, 'no_atomic', False)
+    debounce = getattr(opts, 'debounce', watcher.DEBOUNCE)
+    polling = getattr(opts, 'poll', False)
+
+    couchapp_config = Config()
+    couchapp_config.update(path_app)
+    dbs = couchapp_config.get_dbs(url_dest)
+    doc = document(path_app, create=False,
+                   workers=getattr(opts, 'workers', 1),
+                   processes=getattr(opts, 'processes', False),
+                   signature_algorithm=getattr(opts, 'signature_algorithm',
+                                               util.DEFAULT_SIGNATURE_ALGORITHM))
+    docspath = os.path.join(path_app, '_docs')
+
+    def skip(relpath):
+        # .couchappignore isn't built, but changes the build
+        return relpath != '.couchappignore' and doc.is_skipped(relpath)
+
+    w = watcher.watcher(path_app, skip, polling=polling)
+    print("Watching {} for changes, press Ctrl-C to stop".format(path_app))
+    try:
+        while True:
+            changed = watcher.wait_changes(w, debounce)
+            start = time.monotonic()
+            try:
+                if '.couchappignore' in changed:
+                    doc.reload_ignores()
+                docs = set(p for p in changed
+                           if p == '_docs' or p.startswith('_docs/'))
+                if changed - docs:
+                    _push_changes(couchapp_config, doc, dbs, changed - docs,
+                                  jobs=jobs, split_views=split_views)
+                if docs and os.path.exists(docspath):
+                    pushdocs(couchapp_config, docspath, url_dest, False,
+                             noatomic, False, None, jobs=jobs)
+            except Exception as e:
+                # keep watching, the next change may fix it
+                logger.error("push failed: %s", e)
+                continue
+            logger.info("pushed in %.2fs", time.monotonic() - start)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        w.close()
+    return 0
+
+
+def _push_changes(conf, doc, dbs, changed, jobs=1, split_views=False):
+    """
+    Rebuild ``doc`` after the files ``changed`` changed and push it.
+    """
+    macros = MacroCache(doc.docdir, doc.cache_dir)
+    for relpath in sorted(changed):
+        functions = macros.dependents(relpath)
+        if functions:
+            logger.info("changed: %s (included by %s)", relpath,
+                        ', '.join(functions))
+        else:
+            logger.info("changed: %s", relpath)
+
+    doc.build(refresh=True)
+    attachments = any(is_attachment(p) for p in changed)
+    hook(conf, doc.docdir, "pre-push", dbs=dbs)
+    doc.push(dbs, noatomic=attachments, noindex=True, jobs=jobs,
+             split_views=split_views)
+    hook(conf, doc.docdir, "post-push", dbs=dbs)
+
+
+def _iter_docs_json(docs):
+    """
+    Yield the JSON of ``{"docs": docs}`` piece by piece, the documents being
+    dicts or ``LocalDoc`` whose attachments are streamed.
+    """
+    encoder = util.json.JSONEncoder()
+    yield '{"docs": ['
+    for i, doc in enumerate(docs):
+        if i:
+            yield ', '
+        if hasattr(doc, 'iter_json'):
+            for chunk in doc.iter_json():
+                yield chunk
+        else:
+            yield encoder.encode(doc)
+    yield ']}'
+
+
 def version():
     print("Couchapp (version {})\n".format(__version__))
 
@@ -149,7 +401,9 @@ def main():
     Entry door taking the necessary parameters via command line
     """
     parser = argparse.ArgumentParser(prog='couchapp', description="CMSCouchApp Tool")
-    parser.add_argument('push', default="push")
+    parser.add_argument('command', choices=['push', 'watch'],
+                        help='push the CouchApp, or push it and then push its '
+                             'changes as they happen')
     parser.add_argument('-p', '--path_app', help='Absolute path to the couch app to be installed')
     parser.add_argument('-c', '--couch_uri', help='Target couch URI with the database name')
     parser.add_argument('-v', '--version', action="store_true", help='Display version and exit')
@@ -159,9 +413,41 @@ def main():
     parser.add_argument('-e', '--export', action="store_true",
                         help='Do not push, just export doc to stdout')
     parser.add_argument('-o', '--output', help='If --export is enabled, output to the file')
+    parser.add_argument('--build-cache', metavar='DIR',
+                        help='If --export is enabled, directory of the cache of the '
+                             'exported documents (default: .couchapp/cache/builds '
+                             'in the app)')
+    parser.add_argument('--no-build-cache', action="store_true",
+                        help='If --export is enabled, always build the document')
     parser.add_argument('-f', '--force', action="store_true",
                         help='Force attachments sending')
+    parser.add_argument('-m', '--multipart', action="store_true",
+                        help='Stream the document and its attachments from disk '
+                             'in a single multipart request')
+    parser.add_argument('--split-views', action="store_true",
+                        help='Push the views in a separate <name>-views design document, '
+                             'only updated when the views change')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of databases (or documents with --no-atomic) '
+                             'to push to concurrently, 1 by default or %d with '
+                             '--asyncio' % DEFAULT_ASYNC_JOBS)
+    parser.add_argument('--asyncio', action="store_true",
+                        help='Push to the databases from an asyncio event loop '
+                             '(requires aiohttp), --jobs of them at a time')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of workers hashing and encoding attachments')
+    parser.add_argument('--processes', action="store_true",
+                        help='Use processes instead of threads as workers')
+    parser.add_argument('--signature-algorithm', default=util.DEFAULT_SIGNATURE_ALGORITHM,
+                        choices=sorted(util.SIGNATURE_ALGORITHMS),
+                        help='Hash algorithm of the attachment signatures')
+    # watch options
+    parser.add_argument('--poll', action="store_true",
+                        help='Poll the app directory instead of using inotify')
+    parser.add_argument('--debounce', type=float, default=watcher.DEBOUNCE,
+                        help='Seconds without change ending a burst of changes')
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     if args.version:
         version()
 
@@ -171,7 +457,10 @@ def main():
         sys.exit(1)
 
     # Now actually push the Apps
-    push(args.path_app, args.couch_uri, args)
+    if args.command == 'watch':
+        watch(args.path_app, args.couch_uri, args)
+    else:
+        push(args.path_app, args.couch_uri, args)
     sys.exit(0)
 
 
@@ -9,6 +9,7 @@ import re
 from copy import deepcopy
 
 from couchapp import util
+from couchapp.aioclient import AsyncDatabase
 from couchapp.client import Database
 from couchapp.errors import AppError
 
@@ -25,6 +26,7 @@ class Config(object):
             env={},
             extensions=[],
             hooks={},
+            http={},
             vendors=[]
     )
 
@@ -140,9 +142,13 @@ class Config(object):
         )
 
     # TODO: add oauth management
-    def get_dbs(self, db_string=None):
+    def get_dbs(self, db_string=None, aio=False):
         """
         :type db_string: str
+        :param aio: If ``True``, return ``aioclient.AsyncDatabase`` objects,
+            the databases are then not created
+        :return: databases handles, created on their first write (see
+            ``client.create_dbs`` to create them beforehand)
         """
         db_string = db_string or ''
         env = self.conf.get('env', {})
@@ -167,8 +173,14 @@ class Config(object):
             dburls = [dburls]
 
         use_proxy = any(k in os.environ for k in ('http_proxy', 'https_proxy'))
-
-        return [Database(dburl, use_proxy=use_proxy) for dburl in dburls]
+        # connection pool settings: pool_size, max_retries and keepalive
+        http_opts = self.conf.get('http', {})
+
+        if aio:
+            return [AsyncDatabase(dburl, use_proxy=use_proxy, **http_opts)
+                    for dburl in dburls]
+        return [Database(dburl, lazy=True, use_proxy=use_proxy, **http_opts)
+                for dburl in dburls]
 
     def get_app_name(self, dbstring=None, default=None):
         dbstring = dbstring or ''
@@ -7,7 +7,7 @@ class CouchError(Exception):
     """Generic error thrown by CouchDB"""
 
     def __init__(self, reason, http_code=None, response=None):
-        super(CouchError, self).__init__(self)
+        super(CouchError, self).__init__(reason)
         self.reason = reason
         self.http_code = http_code
         self.response = response
@@ -35,7 +35,7 @@ class ScriptError(Exception):
     """ exception raised in external script"""
 
 
-class PreconditionFailed(Exception):
+class PreconditionFailed(CouchError):
     """ precondition failed error """
 
 
@@ -63,7 +63,8 @@ class BulkSaveError(CouchError):
     """ error raised when therer are conflicts in bulk save"""
 
     def __init__(self, docs, errors):
-        super(BulkSaveError, self).__init__(self)
+        super(BulkSaveError, self).__init__(
+            "%d documents not saved" % len(errors))
         self.docs = docs
         self.errors = errors
 
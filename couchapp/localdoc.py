@@ -5,19 +5,23 @@
 
 
 
+import asyncio
 import base64
+import functools
+import hashlib
 import logging
 import mimetypes
 import os
 import os.path
 import re
+import threading
 import urllib.parse
-from copy import copy
-from itertools import chain
+from collections import namedtuple
 
-from couchapp import util
-from couchapp.errors import ResourceNotFound
-from couchapp.macros import package_shows, package_views
+from couchapp import __version__, util
+from couchapp.cache import MacroCache, SignatureCache, TreeSignatureCache
+from couchapp.errors import AppError, ResourceNotFound
+from couchapp.macros import MacroEngine
 
 re_comment = re.compile("((?:\/\*(?:[^*]|(?:\*+[^*\/]))*\*+\/)|(?:\/\/.*))")
 
@@ -31,19 +35,121 @@ DEFAULT_IGNORE = """[
 
 logger = logging.getLogger(__name__)
 
+# Result of ``LocalDoc.build()``: ``doc`` is the database independent
+# document, ``attachments`` a tuple of ``(name, filepath)``, ``stubs``
+# the base64 encoded attachments and ``signatures`` the signatures of the
+# attachments by algorithm. ``stubs`` and ``signatures`` are filled on
+# demand and shared by all the databases the document is pushed to.
+DocBuild = namedtuple('DocBuild', ['doc', 'attachments', 'stubs',
+                                   'signatures'])
+
+# fields CouchDB computes the signature of the view indexes from,
+# changing one of them rebuilds all the views of the design document
+VIEW_FIELDS = ('views', 'language', 'options')
+
+# suffix of the design document holding the views with ``split_views``
+VIEWS_DOC_SUFFIX = '-views'
+
+# databases pushed to at the same time by ``push_async``
+DEFAULT_ASYNC_JOBS = 100
+
+
+class IgnoreMatcher(object):
+    """
+    The ``.couchappignore`` patterns, compiled once in a single regex.
+
+    A path is ignored when a pattern matches (``re.match(pattern + '$')``)
+    one of its sub paths, see ``LocalDoc.check_ignore``.
+    """
+    re_backref = re.compile(r'\\\d|\\g<|\(\?P=')
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.regexes = self._compile(self.patterns)
+
+    @classmethod
+    def _compile(cls, patterns):
+        if not patterns:
+            return []
+        # keep each pattern anchored on its own: ``a|b`` must give ``a|b$``
+        combined = '|'.join('(?:%s$)' % p for p in patterns)
+        if not cls.re_backref.search(combined):
+            try:
+                return [re.compile(combined)]
+            except re.error:
+                pass
+        # back references, inline flags or duplicated group names
+        # don't survive the concatenation
+        return [re.compile(p + '$') for p in patterns]
+
+    def match(self, item, parent_checked=False):
+        """
+        :param item: relative path
+        :param parent_checked: if True, the parent dir of ``item`` is known
+            not to be ignored, so only the sub paths ending with the last
+            component are checked.
+        """
+        if not self.regexes:
+            return False
+
+        # same as ``util.split_path``, without its per-component syscalls
+        parts = os.path.normpath(item).split('/')
+        if not parts[0] and len(parts) > 1:
+            parts = ['/' + parts[1]] + parts[2:]
+        size = len(parts)
+        if parent_checked:
+            paths = ['/'.join(parts[i:]) for i in range(size)]
+            paths.append('/' + paths[0])
+        else:
+            paths = ['/'.join(parts[i:j]) for i in range(size)
+                     for j in range(i + 1, size + 1)]
+            paths.extend('/' + p for p in paths[:size])
+
+        return any(regex.match(p) for regex in self.regexes for p in paths)
+
 
 class LocalDoc(object):
 
-    def __init__(self, path, create=False, docid=None, is_ddoc=True):
+    def __init__(self, path, create=False, docid=None, is_ddoc=True,
+                 workers=1, processes=False,
+                 signature_algorithm=util.DEFAULT_SIGNATURE_ALGORITHM,
+                 cache_dir=None):
+        """
+        :param workers: size of the pool attachments are hashed and
+            encoded on
+        :param processes: If ``True`` use a pool of processes instead
+            of threads
+        :param signature_algorithm: hash algorithm of the attachment
+            signatures, see ``util.SIGNATURE_ALGORITHMS``
+        :param cache_dir: directory of the persistent caches,
+            ``.couchapp/cache`` under ``path`` by default
+        """
+        if signature_algorithm not in util.SIGNATURE_ALGORITHMS:
+            raise AppError("unknown signature algorithm '{0}'".format(
+                signature_algorithm))
         self.docdir = path
-        self.ignores = self._load_ignores()
+        self.workers = workers
+        self.processes = processes
+        self.signature_algorithm = signature_algorithm
+        self.cache_dir = cache_dir
+        self.reload_ignores()
         self.is_ddoc = is_ddoc
         self.docid = docid if docid else self.get_id()
         self._doc = {'_id': self.docid}
+        self._build = None
+        # the targets pushed to concurrently share the stubs of the build
+        self._stubs_lock = threading.Lock()
 
         if create:
             self.create()
 
+    def reload_ignores(self):
+        """
+        (Re)load the ignore rules from ``.couchappignore``.
+        """
+        self.ignores = self._load_ignores()
+        self._ignore_matcher = IgnoreMatcher(self.ignores)
+
     def _load_ignores(self):
         """
         load ignores from ``.couchappignore``
@@ -100,53 +206,236 @@ class LocalDoc(object):
             logger.info("CouchApp already initialized in %s.", self.docdir)
 
     def push(self, dbs, noatomic=False, browser=False, force=False,
-             noindex=False):
+             noindex=False, jobs=1, multipart=False, split_views=False):
         """
         Push a doc to a list of database ``dbs``.
 
         :param noatomic: If true, each attachments will be sent one by one.
         :param browser: If true, open browser after pushed.
+        :param jobs: number of databases pushed at the same time. The
+            document is built once and shared by all the targets.
+        :param multipart: If true, the document and its changed attachments
+            are streamed from disk in a single ``multipart/related`` request.
+        :param split_views: If true, the views of a design document are
+            pushed in a separate ``<docid>-views`` design document, which is
+            only updated (and reindexed) when the views change.
         """
-        for db in dbs:
-            if noatomic:
-                doc = self.doc(db, with_attachments=False, force=force)
-                db.save_doc(doc, force_update=True)
-
-                attachments = doc.get('_attachments') or {}
-
-                for name, filepath in self.attachments():
-                    if name not in attachments:
-                        logger.debug("attach %s ", name)
-                        db.put_attachment(doc, open(filepath, "r"),
-                                          name=name)
-            else:
-                doc = self.doc(db, force=force)
-                db.save_doc(doc, force_update=True)
-            indexurl = self.index(db.raw_uri, doc['couchapp'].get('index'))
-            if indexurl and not noindex:
-                if "@" in indexurl:
-                    u = urllib.parse.urlparse(indexurl)
-                    indexurl = urllib.parse.urlunparse((u.scheme,
-                                                    u.netloc.split("@")[-1],
-                                                    u.path, u.params, u.query,
-                                                    u.fragment))
-
-                logger.info("Visit your CouchApp here:\n%s", indexurl)
+        build = self.build()
+
+        def push_db(db):
+            return self._push_db(db, build, noatomic, force, noindex,
+                                 multipart, split_views)
+
+        if jobs <= 1 or len(dbs) <= 1:
+            for db in dbs:
+                push_db(db)
+            return
+
+        results = util.run_parallel(push_db, dbs, jobs)
+
+        errors = []
+        for db, _, error in results:
+            if error is not None:
+                logger.error("%s: push failed: %s",
+                             util.sanitizeURL(db.raw_uri)['url'], error)
+                errors.append(error)
+        if errors:
+            raise errors[0]
+
+    def _push_db(self, db, build, noatomic=False, force=False, noindex=False,
+                 multipart=False, split_views=False):
+        """
+        Push the document ``build`` returned by ``build()`` to ``db``.
+        """
+        url = util.sanitizeURL(db.raw_uri)['url']
+        if split_views and self.docid.startswith('_design/'):
+            build = self._push_views(db, build)
+
+        olddoc = self._open_olddoc(db)
+        if not force and self._is_uptodate(build, olddoc):
+            logger.info("%s: %s is up to date", url, self.docid)
+            return olddoc
+
+        self._log_changes(url, build, olddoc)
+
+        if multipart and not noatomic:
+            doc = self._merge(build, olddoc, with_attachments=False)
+            if force:
+                doc['_attachments'] = {}
+            changed = [(name, filepath, self.content_type(name))
+                       for name, filepath in build.attachments
+                       if name not in doc['_attachments']]
+            db.save_doc_multipart(doc, changed, force_update=True)
+        elif noatomic:
+            doc = self._merge(build, olddoc, with_attachments=False,
+                              force=force)
+            db.save_doc(doc, force_update=True)
+
+            attachments = set(doc.get('_attachments') or {})
+
+            # each upload needs the revision created by the previous one,
+            # so the attachments of a document are sent one after another
+            for name, filepath in build.attachments:
+                if name not in attachments:
+                    logger.debug("attach %s ", name)
+                    with open(filepath, "rb") as f:
+                        db.put_attachment(doc, f, name=name,
+                                          content_type=self.content_type(name))
+        else:
+            doc = self._merge(build, olddoc, force=force)
+            db.save_doc(doc, force_update=True)
+        logger.info("%s: pushed %s", url, self.docid)
+        if not noindex:
+            self._log_index(db, doc)
+        return doc
+
+    def _log_changes(self, url, build, olddoc):
+        """
+        Log the fields of ``olddoc`` changed by ``build``, and warn when
+        the views will be rebuilt.
+        """
+        if not olddoc:
+            return
+        changed = diff_fields(olddoc, build.doc)
+        logger.info("%s: %s changed: %s", url, self.docid,
+                    ', '.join(changed) or 'nothing')
+        reindex = [f for f in VIEW_FIELDS if f in changed]
+        if reindex and build.doc.get('views'):
+            logger.warning("%s: %s of %s changed, CouchDB will rebuild "
+                           "all its views", url, ', '.join(reindex),
+                           self.docid)
+
+    def _log_index(self, db, doc):
+        indexurl = self.index(db.raw_uri, doc['couchapp'].get('index'))
+        if indexurl:
+            if "@" in indexurl:
+                u = urllib.parse.urlparse(indexurl)
+                indexurl = urllib.parse.urlunparse((u.scheme,
+                                                u.netloc.split("@")[-1],
+                                                u.path, u.params, u.query,
+                                                u.fragment))
+
+            logger.info("Visit your CouchApp here:\n%s", indexurl)
+
+    async def push_async(self, dbs, noatomic=False, force=False,
+                         noindex=False, jobs=DEFAULT_ASYNC_JOBS):
+        """
+        Coroutine counterpart of ``push``, to ``aioclient.AsyncDatabase``
+        targets. The databases are pushed to from the running event loop,
+        at most ``jobs`` at the same time, instead of a thread each. The
+        build and the encoding of the attachments run in the default
+        executor.
+
+        A failing database doesn't stop the others, the first error is
+        raised once they are all done.
+        """
+        loop = asyncio.get_running_loop()
+        build = await loop.run_in_executor(None, self.build)
+        semaphore = asyncio.Semaphore(max(jobs, 1))
+
+        async def push_db(db):
+            async with semaphore:
+                return await self._push_db_async(db, build, noatomic, force,
+                                                 noindex)
+
+        results = await asyncio.gather(*[push_db(db) for db in dbs],
+                                       return_exceptions=True)
+        errors = []
+        for db, result in zip(dbs, results):
+            if isinstance(result, Exception):
+                logger.error("%s: push failed: %s",
+                             util.sanitizeURL(db.raw_uri)['url'], result)
+                errors.append(result)
+        if errors:
+            raise errors[0]
+
+    async def _push_db_async(self, db, build, noatomic=False, force=False,
+                             noindex=False):
+        """
+        ``_push_db`` to an ``aioclient.AsyncDatabase``.
+        """
+        url = util.sanitizeURL(db.raw_uri)['url']
+        try:
+            olddoc = await db.open_doc(self.docid)
+        except ResourceNotFound:
+            olddoc = {}
+        if not force and self._is_uptodate(build, olddoc):
+            logger.info("%s: %s is up to date", url, self.docid)
+            return olddoc
+
+        self._log_changes(url, build, olddoc)
+
+        loop = asyncio.get_running_loop()
+        merge = functools.partial(self._merge, build, olddoc,
+                                  with_attachments=not noatomic, force=force)
+        doc = await loop.run_in_executor(None, merge)
+        await db.save_doc(doc, force_update=True)
+        if noatomic:
+            attachments = set(doc.get('_attachments') or {})
+            for name, filepath in build.attachments:
+                if name not in attachments:
+                    logger.debug("attach %s ", name)
+                    content = await loop.run_in_executor(
+                        None, functools.partial(util.read, filepath,
+                                                utf8=False))
+                    await db.put_attachment(
+                        doc, content, name=name,
+                        content_type=self.content_type(name))
+        logger.info("%s: pushed %s", url, self.docid)
+        if not noindex:
+            self._log_index(db, doc)
+        return doc
+
+    def _push_views(self, db, build):
+        """
+        Push the views of ``build`` in their own design document, if they
+        changed, and return ``build`` without them. The views document is
+        left alone when its fields are the same, even with ``force``:
+        rewriting it would only get CouchDB to rebuild the same views.
+        """
+        if not build.doc.get('views'):
+            return build
+
+        url = util.sanitizeURL(db.raw_uri)['url']
+        viewsdoc = {'_id': self.docid + VIEWS_DOC_SUFFIX}
+        doc = dict(build.doc)
+        for f in VIEW_FIELDS:
+            if f in doc:
+                # the language is also needed by the shows, lists...
+                viewsdoc[f] = doc[f] if f == 'language' else doc.pop(f)
+
+        try:
+            olddoc = db.open_doc(viewsdoc['_id'])
+        except ResourceNotFound:
+            olddoc = {}
+
+        if diff_fields(olddoc, viewsdoc):
+            if olddoc:
+                logger.warning("%s: views of %s changed, CouchDB will "
+                               "rebuild them", url, self.docid)
+                viewsdoc['_rev'] = olddoc['_rev']
+            db.save_doc(viewsdoc, force_update=True)
+            logger.info("%s: pushed %s", url, viewsdoc['_id'])
+        else:
+            logger.info("%s: %s is up to date", url, viewsdoc['_id'])
+
+        doc['couchapp'] = dict(doc['couchapp'])
+        doc['couchapp']['fingerprint'] = fingerprint(doc)
+        return build._replace(doc=doc)
 
     def attachment_stub(self, name, filepath):
         """
         Encode a byte-like object (attachment) using Base64, but return
         it in a text string format instead of bytes
         """
-        re_sp = re.compile('\s')
-        # Alan: strings are tough to deal in python3...
-        # read a binary file and encode its bytes in base64
-        content = util.read(filepath, utf8=False)
-        b64content = base64.b64encode(util.to_bytestring(content))
-        # then decode back to a string sequence
-        att = {"data": re_sp.sub('', b64content.decode("utf-8")),
-               "content_type": ';'.join([_f for _f in mimetypes.guess_type(name) if _f])}
-        return att
+        return attachment_stub(name, filepath)
+
+    @staticmethod
+    def content_type(name):
+        """
+        Guess the content type of the attachment ``name``
+        """
+        return content_type(name)
 
     def doc(self, db=None, with_attachments=True, force=False):
         """
@@ -155,80 +444,73 @@ class LocalDoc(object):
         :param with_attachments: If ``True``,
             attachments will be included and encoded
         """
-        manifest = []
-        objects = {}
-        signatures = {}
-        attachments = {}
+        olddoc = self._open_olddoc(db)
+        doc = self._merge(self.build(), olddoc,
+                          with_attachments=with_attachments, force=force)
+        # may be called for several databases at the same time
+        self.olddoc, self._doc = olddoc, doc
+        return doc
+
+    def build(self, refresh=False):
+        """
+        Build the part of the document which doesn't depend on the target
+        database: fields, ``couchapp`` metadata and macros.
 
-        self._doc = {'_id': self.docid}
+        The result is cached, so the app directory is only read once
+        whatever the number of databases the document is pushed to.
+        It must not be modified, ``_merge`` copies what it changes.
 
-        # get designdoc
-        self._doc.update(self.dir_to_fields(self.docdir, manifest=manifest))
+        :param refresh: If ``True``, rebuild from the app directory
+        :return: ``DocBuild``
+        """
+        if self._build is None or refresh:
+            self._build = self._build_doc()
+        return self._build
 
-        if 'couchapp' not in self._doc:
-            self._doc['couchapp'] = {}
+    def _build_doc(self):
+        objects = {}
+        signatures = {}
 
-        self.olddoc = {}
-        if db is not None:
-            try:
-                self.olddoc = db.open_doc(self._doc['_id'])
-                attachments = self.olddoc.get('_attachments') or {}
-                self._doc.update({'_rev': self.olddoc['_rev']})
-            except ResourceNotFound:
-                self.olddoc = {}
-
-        if 'couchapp' in self.olddoc:
-            old_signatures = self.olddoc['couchapp'].get('signatures', {})
-        else:
-            old_signatures = {}
+        doc = {'_id': self.docid}
 
-        for name, filepath in self.attachments():
-            signatures[name] = util.sign(filepath)
-            if with_attachments and not old_signatures:
-                logger.debug("attach %s ", name)
-                attachments[name] = self.attachment_stub(name, filepath)
-
-        if old_signatures:
-            for name, signature in list(old_signatures.items()):
-                cursign = signatures.get(name)
-                if not cursign:
-                    logger.debug("detach %s ", name)
-                    del attachments[name]
-                elif cursign != signature:
-                    logger.debug("detach %s ", name)
-                    del attachments[name]
-                else:
-                    continue
+        # get designdoc and attachments in a single walk
+        fields, manifest, found = self.scan()
+        doc.update(fields)
 
-            if with_attachments:
-                for name, filepath in self.attachments():
-                    if old_signatures.get(name) != \
-                            signatures.get(name) or force:
-                        logger.debug("attach %s ", name)
-                        attachments[name] = self.attachment_stub(name,
-                                                                 filepath)
+        if 'couchapp' not in doc:
+            doc['couchapp'] = {}
 
-        self._doc['_attachments'] = attachments
+        sigcache = SignatureCache(self.docdir, self.signature_algorithm,
+                                  self.cache_dir)
+        hashes = sigcache.sign_all([(filepath, st) for _, filepath, st in found],
+                                   workers=self.workers,
+                                   processes=self.processes)
+        for (name, _, _), signature in zip(found, hashes):
+            signatures[name] = signature
+        sigcache.save()
+        attachments = tuple((name, filepath) for name, filepath, st in found)
 
-        self._doc['couchapp'].update({
+        doc['couchapp'].update({
             'manifest': manifest,
             'objects': objects,
-            'signatures': signatures
+            'signatures': signatures,
+            'signature_algorithm': self.signature_algorithm
         })
 
         if self.docid.startswith('_design/'):  # process macros
+            macros = MacroEngine(self.docdir,
+                                 MacroCache(self.docdir, self.cache_dir))
             for funs in ['shows', 'lists', 'updates', 'filters', 'spatial']:
-                if funs in self._doc:
-                    package_shows(self._doc, self._doc[funs], self.docdir,
-                                  objects)
+                if funs in doc:
+                    macros.package_shows(doc, doc[funs], objects, funs + '/')
 
-            if 'validate_doc_update' in self._doc:
+            if 'validate_doc_update' in doc:
                 tmp_dict = {'validate_doc_update':
-                                self._doc["validate_doc_update"]}
-                package_shows(self._doc, tmp_dict, self.docdir, objects)
-                self._doc.update(tmp_dict)
+                                doc["validate_doc_update"]}
+                macros.package_shows(doc, tmp_dict, objects)
+                doc.update(tmp_dict)
 
-            if 'views' in self._doc:
+            if 'views' in doc:
                 # clean views
                 # we remove empty views and malformed from the list
                 # of pushed views. We also clean manifest
@@ -241,19 +523,174 @@ class LocalDoc(object):
                             name = name[:-1]
                         dmanifest[name] = i
 
-                for vname, value in self._doc['views'].items():
+                for vname, value in doc['views'].items():
                     if value and isinstance(value, dict):
                         views[vname] = value
                     else:
                         del manifest[dmanifest["views/%s" % vname]]
-                self._doc['views'] = views
-                package_views(self._doc, self._doc["views"], self.docdir,
-                              objects)
+                doc['views'] = views
+                macros.package_views(doc, doc["views"], objects, 'views/')
+
+            if "fulltext" in doc:
+                macros.package_views(doc, doc["fulltext"], objects,
+                                      'fulltext/')
+            macros.save()
+
+        doc['couchapp']['fingerprint'] = fingerprint(doc)
+        return DocBuild(doc, attachments, {},
+                        {self.signature_algorithm: signatures})
+
+    @staticmethod
+    def _is_uptodate(build, olddoc):
+        """
+        Tell if ``olddoc`` was pushed from the same sources as ``build``
+        and has all its attachments, in which case pushing it again would
+        only create a new revision and rebuild its views.
+        """
+        oldfingerprint = olddoc.get('couchapp', {}).get('fingerprint')
+        if oldfingerprint != build.doc['couchapp']['fingerprint']:
+            return False
+        oldattachments = olddoc.get('_attachments') or {}
+        return all(name in oldattachments for name, _ in build.attachments)
+
+    def _open_olddoc(self, db):
+        """
+        Fetch the current version of the document from ``db``,
+        return ``{}`` if there is none.
+        """
+        if db is None:
+            return {}
+        try:
+            return db.open_doc(self.docid)
+        except ResourceNotFound:
+            return {}
+
+    def _merge(self, build, olddoc, with_attachments=True, force=False):
+        """
+        Merge the document ``build`` returned by ``build()`` with the
+        revision and attachments of ``olddoc``. Only the attachments whose
+        signature changed are encoded, once per build.
+        """
+        files = build.attachments
+        doc = dict(build.doc)
+        doc['couchapp'] = dict(build.doc['couchapp'])
+        signatures = doc['couchapp']['signatures']
+
+        attachments = dict(olddoc.get('_attachments') or {})
+        if '_rev' in olddoc:
+            doc['_rev'] = olddoc['_rev']
+
+        if 'couchapp' in olddoc:
+            old_signatures = olddoc['couchapp'].get('signatures', {})
+            # docs pushed before the algorithm was recorded used md5
+            old_algorithm = olddoc['couchapp'].get(
+                    'signature_algorithm', 'md5')
+            if old_signatures and old_algorithm != self.signature_algorithm:
+                signatures = self._signatures(build, old_algorithm)
+        else:
+            old_signatures = {}
 
-            if "fulltext" in self._doc:
-                package_views(self._doc, self._doc["fulltext"], self.docdir,
-                              objects)
-        return self._doc
+        for name, signature in list(old_signatures.items()):
+            cursign = signatures.get(name)
+            if not cursign or cursign != signature:
+                logger.debug("detach %s ", name)
+                attachments.pop(name, None)
+
+        if with_attachments:
+            files = [(name, filepath) for name, filepath in files
+                     if not old_signatures or force or
+                     old_signatures.get(name) != signatures.get(name)]
+            self._encode_stubs(build, files)
+            for name, filepath in files:
+                logger.debug("attach %s ", name)
+                attachments[name] = build.stubs[name]
+
+        doc['_attachments'] = attachments
+        return doc
+
+    def _signatures(self, build, algorithm):
+        """
+        Signatures of the attachments of ``build`` computed with
+        ``algorithm``, to compare them with a document pushed with another
+        algorithm. If it isn't available here, the signatures are empty and
+        all the attachments are considered changed.
+        """
+        if algorithm not in build.signatures:
+            signatures = {}
+            if algorithm in util.SIGNATURE_ALGORITHMS:
+                sigcache = SignatureCache(self.docdir, algorithm,
+                                          self.cache_dir)
+                hashes = sigcache.sign_all(
+                        [(filepath, None) for _, filepath in build.attachments],
+                        workers=self.workers, processes=self.processes)
+                sigcache.save()
+                signatures = dict((name, signature) for (name, _), signature
+                                  in zip(build.attachments, hashes))
+            build.signatures[algorithm] = signatures
+        return build.signatures[algorithm]
+
+    def _encode_stubs(self, build, files):
+        """
+        Encode the attachments ``files`` of ``build`` which aren't yet,
+        on the worker pool. Concurrent pushes wait for the encoding of
+        the first one instead of encoding the same files again.
+        """
+        with self._stubs_lock:
+            files = [(name, filepath) for name, filepath in files
+                     if name not in build.stubs]
+            stubs = util.pool_map(attachment_stub,
+                                  [name for name, _ in files],
+                                  [filepath for _, filepath in files],
+                                  workers=self.workers,
+                                  processes=self.processes)
+            for (name, _), stub in zip(files, stubs):
+                build.stubs[name] = stub
+
+    def tree_fingerprint(self):
+        """
+        Content hash of what the document is built from: the files of the
+        app directory (but ``_docs`` and the dot entries outside of the
+        attachments, which aren't built), the ignore rules, the document id,
+        the signature algorithm and the couchapp version. Unlike mtimes, it
+        is the same in every checkout of the same tree.
+        """
+        files = []
+        stack = [(self.docdir, '')]
+        while stack:
+            current, rel = stack.pop()
+            with os.scandir(current) as it:
+                entries = list(it)
+            for entry in entries:
+                rel_path = '%s/%s' % (rel, entry.name) if rel else entry.name
+                if rel_path == '_docs' or self.is_skipped(
+                        rel_path, entry, parent_checked=bool(rel)):
+                    continue
+                if entry.is_dir():
+                    stack.append((entry.path, rel_path))
+                else:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        st = None
+                    files.append((rel_path, entry.path, st))
+        files.sort()
+
+        sigcache = TreeSignatureCache(self.docdir, 'sha256',
+                                      self.cache_dir)
+        hashes = sigcache.sign_all([(path, st) for _, path, st in files],
+                                   workers=self.workers,
+                                   processes=self.processes)
+        sigcache.save()
+
+        content = util.json.dumps({
+            'version': __version__,
+            'docid': self.docid,
+            'ignores': self.ignores,
+            'signature_algorithm': self.signature_algorithm,
+            'files': [[rel_path, signature] for (rel_path, _, _), signature
+                      in zip(files, hashes)]
+        }, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
     def check_ignore(self, item):
         """
@@ -266,43 +703,42 @@ class LocalDoc(object):
             * ``bar/baz.json`` vs ``bar`` -> True, then return
             * ``baz.json`` vs ``bar`` -> not checked
         """
-        item = os.path.normpath(item)
-
-        for pattern in self.ignores:
-            # ('/' + item) is for abs path, some duplicated generated but work
-            paths = chain(self._combine_path(item),
-                          self._combine_path('/' + item))
-            matches = (re.match(pattern + '$', i) for i in paths)
-            if any(matches):
-                logger.debug("ignoring %s", item)
-                return True
+        if self._ignore_matcher.match(item):
+            logger.debug("ignoring %s", item)
+            return True
         return False
 
-    @classmethod
-    def _combine_path(cls, p):
+    def _check_ignore_entry(self, item):
         """
-        >>> tuple(LocalDoc._combine_path('foo/bar/qaz'))
-        ('foo', 'foo/bar', 'foo/bar/qaz', 'bar', 'bar/qaz', 'qaz')
-
-        >>> tuple(LocalDoc._combine_path('/foo/bar/qaz'))
-        ('/foo', '/foo/bar', '/foo/bar/qaz', 'bar', 'bar/qaz', 'qaz')
+        Same as ``check_ignore``, for a path whose parent directory was
+        already checked: only the sub paths ending with its last
+        component can still match.
         """
-        ls = util.split_path(p)
-        while ls:
-            for i in cls._combine_dir(copy(ls)):
-                yield i
-            ls.pop(0)
+        if self._ignore_matcher.match(item, parent_checked=True):
+            logger.debug("ignoring %s", item)
+            return True
+        return False
 
-    @staticmethod
-    def _combine_dir(ls):
+    def is_skipped(self, item, entry=None, parent_checked=False):
         """
-        >>> tuple(LocalDoc._combine_dir(['foo', 'bar', 'qaz']))
-        ('foo', 'foo/bar', 'foo/bar/qaz')
+        Return True if the walks of the app directory don't descend in, or
+        don't read, the relative path ``item``: the dot entries which
+        aren't built (see ``is_hidden``), the ignored paths and, like
+        ``os.walk``, the symlinks to directories under the attachments.
+        The dot vendors are walked for their ``_attachments``.
+
+        :param entry: the ``os.DirEntry`` of ``item``, if known
+        :param parent_checked: If ``True``, the parent directory of
+            ``item`` was already checked (see ``_check_ignore_entry``)
         """
-        ret = tuple()
-        while ls:
-            ret += (ls.pop(0),)
-            yield '/'.join(ret)
+        parts = item.split('/')
+        if is_hidden(item) and not (len(parts) == 2 and parts[0] == 'vendor'):
+            return True
+        if (self._check_ignore_entry(item) if parent_checked
+                else self.check_ignore(item)):
+            return True
+        return (entry is not None and is_attachment(item) and
+                entry.is_dir() and entry.is_symlink())
 
     def dir_to_fields(self, current_dir=None, depth=0, manifest=None):
         """
@@ -310,19 +746,60 @@ class LocalDoc(object):
 
         :param manifest: ``list``. We will have side effect on this param.
         """
-        fields = {}  # return value
         manifest = manifest if manifest is not None else []
         current_dir = current_dir if current_dir else self.docdir
+        rel_dir = util.relpath(current_dir, self.docdir)
+        return self._scan_dir(current_dir, '' if rel_dir == '.' else rel_dir,
+                              depth, manifest)
+
+    def scan(self):
+        """
+        Walk the app directory once with ``os.scandir`` and collect both
+        the fields and the attachments.
+
+        :return: a tuple ``(fields, manifest, attachments)``, attachments
+            being a list of ``(name, filepath, stat)``. ``stat`` is the
+            ``os.stat_result`` of the file, or None if it can't be read.
+        """
+        manifest = []
+        attachments = ([], [])  # main, vendors
+        fields = self._scan_dir(self.docdir, '', 0, manifest, attachments)
+        return fields, manifest, attachments[0] + attachments[1]
+
+    def _scan_dir(self, current_dir, rel_dir, depth, manifest,
+                  attachments=None):
+        """
+        ``dir_to_fields`` on top of ``os.scandir``. If ``attachments`` is
+        a tuple of two lists, the main and vendor attachments met while
+        walking are added to them.
+        """
+        fields = {}  # return value
 
-        for name in os.listdir(current_dir):
-            current_path = os.path.join(current_dir, name)
-            rel_path = util.relpath(current_path, self.docdir)
-            if name.startswith('.'):
+        with os.scandir(current_dir) as it:
+            entries = list(it)
+
+        for entry in entries:
+            name = entry.name
+            current_path = entry.path
+            rel_path = '%s/%s' % (rel_dir, name) if rel_dir else name
+
+            if attachments is not None and depth == 1 and \
+                    rel_dir == 'vendor' and entry.is_dir():
+                attachdir = os.path.join(current_path, '_attachments')
+                if os.path.isdir(attachdir):
+                    self._scan_attachments(attachdir, attachments[1],
+                                           vendor=name)
+
+            if is_hidden(rel_path):
                 continue
-            elif self.check_ignore(rel_path):
+            elif (self._check_ignore_entry(rel_path) if depth
+                  else self.check_ignore(rel_path)):
                 continue
             elif depth == 0 and name.startswith('_'):
                 # files starting with "_" are always "special"
+                if attachments is not None and name == '_attachments' \
+                        and entry.is_dir():
+                    self._scan_attachments(current_path, attachments[0])
                 continue
             elif name == '_attachments':
                 continue
@@ -330,18 +807,18 @@ class LocalDoc(object):
                 # we are in app_meta
                 if name == "couchapp":
                     manifest.append('%s/' % rel_path)
-                    content = self.dir_to_fields(
-                            current_path, depth=depth + 1, manifest=manifest)
+                    content = self._scan_dir(current_path, rel_path,
+                                             depth + 1, manifest)
                 else:
                     manifest.append(rel_path)
                     content = util.read_json(current_path)
 
                 fields, content = self._meta_to_fields(fields, content)
 
-            elif os.path.isdir(current_path):
+            elif entry.is_dir():
                 manifest.append('%s/' % rel_path)
-                fields[name] = self.dir_to_fields(
-                        current_path, depth=depth + 1, manifest=manifest)
+                fields[name] = self._scan_dir(current_path, rel_path,
+                                              depth + 1, manifest, attachments)
 
             else:  # handler for normal file
                 logger.debug('push %s', rel_path)
@@ -372,7 +849,8 @@ class LocalDoc(object):
         content = content.copy()
         fields = fields.copy()
 
-        for f in ('signatures', 'manifest', 'objects', 'length'):
+        for f in ('signatures', 'manifest', 'objects', 'length',
+                  'fingerprint', 'signature_algorithm'):
             if f in content:
                 del content[f]
 
@@ -416,28 +894,44 @@ class LocalDoc(object):
         Processing directory to yield attachments.
         """
         if not os.path.isdir(path):
-            raise StopIteration()
+            return
 
-        for root, dirs, files in os.walk(path):
-            for dir_ in dirs:
-                _relpath = util.relpath(os.path.join(root, dir_),
-                                        self.docdir)
-                if self.check_ignore(_relpath):
-                    dirs.remove(dir_)
+        attachments = []
+        self._scan_attachments(path, attachments, vendor=vendor)
+        for name, filepath, st in attachments:
+            yield (name, filepath)
 
-            if not files:
-                continue
+    def _scan_attachments(self, path, attachments, vendor=None):
+        """
+        Add the ``(name, filepath, stat)`` of the files under ``path`` to
+        ``attachments``, in the same order as ``os.walk``.
+        """
+        rel_root = util.relpath(path, self.docdir)
+        if self.check_ignore(rel_root):
+            return
 
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                _relpath = util.relpath(filepath, self.docdir)
-                if self.check_ignore(_relpath):
+        prefix = os.path.join('vendor', vendor) if vendor is not None else ''
+        stack = [(path, '')]
+        while stack:
+            root, rel = stack.pop()
+            with os.scandir(root) as it:
+                entries = list(it)
+
+            dirs = []
+            for entry in entries:
+                name = '%s/%s' % (rel, entry.name) if rel else entry.name
+                if self.is_skipped('%s/%s' % (rel_root, name), entry,
+                                   parent_checked=True):
                     continue
-
-                name = util.relpath(filepath, path)
-                if vendor is not None:
-                    name = os.path.join('vendor', vendor, name)
-                yield (name, filepath)
+                if entry.is_dir():
+                    dirs.append((entry.path, name))
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    st = None
+                attachments.append((os.path.join(prefix, name), entry.path, st))
+            stack.extend(reversed(dirs))
 
     def attachments(self):
         """
@@ -479,7 +973,123 @@ class LocalDoc(object):
     def to_json(self):
         return self.__str__()
 
+    def iter_json(self):
+        """
+        Yield the JSON of ``doc()`` piece by piece. The attachments are read
+        and base64 encoded a chunk at a time, so the memory used doesn't
+        grow with their size.
+        """
+        build = self.build()
+        doc = self._merge(build, {}, with_attachments=False)
+        encoder = util.json.JSONEncoder()
+        yield '{'
+        for i, (key, value) in enumerate(doc.items()):
+            yield '%s%s: ' % (', ' if i else '', encoder.encode(key))
+            if key != '_attachments':
+                yield encoder.encode(value)
+                continue
 
-def document(path, create=False, docid=None, is_ddoc=True):
+            yield '{'
+            for j, (name, filepath) in enumerate(build.attachments):
+                yield '%s%s: {"data": "' % (', ' if j else '',
+                                             encoder.encode(name))
+                for chunk in util.iter_base64(filepath):
+                    yield chunk
+                yield '", "content_type": %s}' % encoder.encode(
+                    content_type(name))
+            yield '}'
+        yield '}'
+
+
+def content_type(name):
+    """
+    Guess the content type of the attachment ``name``
+    """
+    return ';'.join([_f for _f in mimetypes.guess_type(name) if _f])
+
+
+def is_attachment(relpath):
+    """
+    Return True if ``relpath`` is under ``_attachments`` or the
+    ``_attachments`` of a vendor.
+    """
+    parts = relpath.split('/')
+    return (len(parts) > 1 and parts[0] == '_attachments') or (
+        len(parts) > 3 and parts[0] == 'vendor' and parts[2] == '_attachments')
+
+
+def is_hidden(relpath):
+    """
+    Return True if ``relpath`` is, or is under, a dot entry which isn't
+    built (``.git``, ``.couchapp`` and the caches written by the push,
+    editor swap files...). Dot entries under the attachments dirs are
+    built, and the ``_attachments`` of a dot vendor too.
+    """
+    parts = relpath.split('/')
+    for i, part in enumerate(parts):
+        if part.startswith('.'):
+            if i == 1 and parts[0] == 'vendor':
+                return len(parts) < 3 or parts[2] != '_attachments'
+            return not is_attachment('/'.join(parts[:i + 1]))
+    return False
+
+
+def attachment_stub(name, filepath):
+    """
+    Read the attachment ``filepath`` and return its inline stub, with the
+    content encoded in base64. This is a module level function so it can
+    run on a pool of processes.
+    """
+    re_sp = re.compile('\s')
+    # Alan: strings are tough to deal in python3...
+    # read a binary file and encode its bytes in base64
+    content = util.read(filepath, utf8=False)
+    b64content = base64.b64encode(util.to_bytestring(content))
+    # then decode back to a string sequence
+    att = {"data": re_sp.sub('', b64content.decode("utf-8")),
+           "content_type": content_type(name)}
+    return att
+
+
+def diff_fields(olddoc, newdoc):
+    """
+    List the top level fields which differ between two versions of a
+    document. Attachments are compared through their signatures, and
+    reported as ``_attachments``.
+    """
+    changed = []
+    for field in sorted(set(olddoc) | set(newdoc)):
+        if field in ('_id', '_rev', '_attachments', 'couchapp'):
+            continue
+        if olddoc.get(field) != newdoc.get(field):
+            changed.append(field)
+
+    oldsigs = olddoc.get('couchapp', {}).get('signatures', {})
+    newsigs = newdoc.get('couchapp', {}).get('signatures', {})
+    if oldsigs != newsigs:
+        changed.append('_attachments')
+    return changed
+
+
+def fingerprint(doc):
+    """
+    Content hash of a built document: its fields after macro expansion and
+    its ``couchapp`` metadata, which holds the attachment signatures.
+    ``_rev``, ``_attachments`` and the fingerprint itself are left out.
+    """
+    doc = dict((k, v) for k, v in doc.items()
+               if k not in ('_rev', '_attachments'))
+    doc['couchapp'] = dict((k, v) for k, v in doc.get('couchapp', {}).items()
+                           if k != 'fingerprint')
+    content = util.json.dumps(doc, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def document(path, create=False, docid=None, is_ddoc=True, workers=1,
+             processes=False,
+             signature_algorithm=util.DEFAULT_SIGNATURE_ALGORITHM,
+             cache_dir=None):
     return LocalDoc(os.path.realpath(path), create=create, docid=docid,
-                    is_ddoc=is_ddoc)
+                    is_ddoc=is_ddoc, workers=workers, processes=processes,
+                    signature_algorithm=signature_algorithm,
+                    cache_dir=cache_dir)
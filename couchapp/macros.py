@@ -8,130 +8,304 @@ from hashlib import md5
 import logging
 import os
 import re
+import time
 
+from couchapp.cache import RACY_WINDOW_NS
 from couchapp.errors import MacroError
 from couchapp import util
 
 logger = logging.getLogger(__name__)
 
+RE_CODE = re.compile(r'(\/\/|#)\ ?!code (.*)')
+RE_JSON = re.compile(r'(\/\/|#)\ ?!json (.*)')
 
-def package_shows(doc, funcs, app_dir, objs):
-    apply_lib(doc, funcs, app_dir, objs)
 
+class MacroEngine(object):
+    """
+    Expand the ``!code`` and ``!json`` macros of the functions of a
+    design document.
 
-def package_views(doc, views, app_dir, objs):
-    for view, funcs in views.items():
-        if hasattr(funcs, "items"):
-            apply_lib(doc, funcs, app_dir, objs)
+    An engine lives for one build: the expanded content of the included
+    files (keyed by path and mtime) and the glob results are cached, so
+    a library included by many functions is only read and expanded once.
 
+    The files, glob patterns and document fields each function depends on
+    are recorded. With a ``cache.MacroCache`` the functions whose
+    dependencies didn't change since the previous build are not expanded
+    again.
+    """
 
-def apply_lib(doc, funcs, app_dir, objs):
-    for k, v in list(funcs.items()):
-        if not isinstance(v, str):
-            continue
-        else:
+    def __init__(self, app_dir, cache=None):
+        self.app_dir = app_dir
+        self.cache = cache
+        self._globs = {}
+        self._stamps = {}
+        self._files = {}
+        self._json_files = {}
+        # files being expanded, to detect include cycles
+        self._stack = []
+        # dependencies of the function and files being expanded
+        self._deps = []
+
+    def package_shows(self, doc, funcs, objs, prefix=''):
+        self.apply_lib(doc, funcs, objs, prefix)
+
+    def package_views(self, doc, views, objs, prefix=''):
+        for view, funcs in views.items():
+            if hasattr(funcs, "items"):
+                self.apply_lib(doc, funcs, objs, '%s%s/' % (prefix, view))
+
+    def apply_lib(self, doc, funcs, objs, prefix=''):
+        """
+        Expand the macros of ``funcs`` in place.
+
+        :param prefix: path of ``funcs`` in the document, e.g. ``shows/``,
+            naming the functions in the dependency graph
+        """
+        for k, v in list(funcs.items()):
+            if not isinstance(v, str):
+                continue
             logger.debug("process function: %s", k)
             old_v = v
             try:
-                funcs[k] = run_json_macros(doc,
-                                           run_code_macros(v, app_dir),
-                                           app_dir)
+                funcs[k] = self.expand(doc, prefix + k, v)
             except ValueError as e:
                 raise MacroError("Error running !code or !json on " +
                                  "function \"%s\": %s" % (k, e))
             if old_v != funcs[k]:
                 objs[md5(util.to_bytestring(funcs[k])).hexdigest()] = old_v
 
+    def expand(self, doc, name, f_string):
+        """
+        Return ``f_string`` with its macros expanded, reusing the result
+        cached for the function ``name`` if none of its dependencies
+        changed.
+        """
+        source = md5(util.to_bytestring(f_string)).hexdigest()
+        if self.cache is not None:
+            entry = self.cache.get(name)
+            if entry is not None and self._is_fresh(doc, source, entry):
+                logger.debug("reuse expanded function: %s", name)
+                return entry['result']
 
-def run_code_macros(f_string, app_dir):
-    def rreq(mo):
-        # just read the file and return it
-        path = os.path.join(app_dir, mo.group(2).strip())
-        library = ''
-        filenum = 0
-        for filename in glob.iglob(path):
+        self._deps.append(_new_deps())
+        try:
+            result = self.run_json_macros(doc, self.run_code_macros(f_string))
+        finally:
+            deps = self._deps.pop()
+
+        if self.cache is not None:
+            if any(self._is_racy(stamp) for stamp in deps['files'].values()):
+                self.cache.discard(name)
+            else:
+                self.cache.store(name, dict(deps, source=source,
+                                            result=result))
+        return result
+
+    def save(self):
+        if self.cache is not None:
+            self.cache.save()
+
+    def run_code_macros(self, f_string):
+        if '!code' not in f_string:
+            return f_string
+        return RE_CODE.sub(self._include_code, f_string)
+
+    def run_json_macros(self, doc, f_string):
+        if '!json' not in f_string:
+            return f_string
+
+        included = {}
+        for mo in RE_JSON.finditer(f_string):
+            source = mo.group(2).strip()
+            if source.startswith('_attachments'):
+                # someone want to include from attachments
+                self._include_attachments(source, included)
+            else:
+                self._include_fields(doc, source, included)
+
+        if not included:
+            return f_string
+
+        varstrings = '\n'.join("var %s = %s;" % (k, util.json.dumps(v))
+                               for k, v in included.items())
+        return RE_JSON.sub(lambda mo: varstrings, f_string)
+
+    def _is_fresh(self, doc, source, entry):
+        if entry.get('source') != source:
+            return False
+        for relpath, stamp in entry['files'].items():
+            if self._stamp(os.path.join(self.app_dir, relpath)) != stamp:
+                return False
+        for pattern, matches in entry['globs'].items():
+            if self._relpaths(self._glob(pattern)) != matches:
+                return False
+        for source, value in entry['fields'].items():
+            if _field_hash(doc, source) != value:
+                return False
+        return True
+
+    @staticmethod
+    def _is_racy(stamp):
+        # a file written within the mtime granularity may change again
+        # without its stamp changing
+        return time.time_ns() - stamp[1] < RACY_WINDOW_NS
+
+    def _relpaths(self, filenames):
+        return [os.path.relpath(f, self.app_dir) for f in filenames]
+
+    def _record(self, deps):
+        if self._deps:
+            for kind, values in deps.items():
+                self._deps[-1][kind].update(values)
+
+    def _stamp(self, filename):
+        if filename not in self._stamps:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                self._stamps[filename] = None
+            else:
+                self._stamps[filename] = [st.st_size, st.st_mtime_ns,
+                                          st.st_ino]
+        return self._stamps[filename]
+
+    def _glob(self, pattern):
+        if pattern not in self._globs:
+            path = os.path.join(self.app_dir, pattern)
+            self._globs[pattern] = list(glob.iglob(path))
+        return self._globs[pattern]
+
+    def _include_code(self, mo):
+        library = []
+        pattern = mo.group(2).strip()
+        filenames = self._glob(pattern)
+        self._record({'globs': {pattern: self._relpaths(filenames)}})
+        if not filenames:
+            raise MacroError("Processing code: No file matching '%s'" %
+                             mo.group(2))
+        for filename in filenames:
+            library.append(self._expand(filename))
+        return ''.join(library)
+
+    def _expand(self, filename):
+        """
+        Return the content of ``filename`` with its own ``!code`` macros
+        expanded.
+        """
+        if filename in self._stack:
+            cycle = self._stack[self._stack.index(filename):] + [filename]
+            raise MacroError("Processing code: include cycle %s" % ' -> '.join(
+                self._relpaths(cycle)))
+
+        stamp = self._stamp(filename)
+        if stamp is None:
+            raise MacroError("Processing code: can't read '%s'" % filename)
+        key = (filename, stamp[1], stamp[0])
+        if key not in self._files:
             logger.debug("process code macro: %s", filename)
             try:
                 cnt = util.read(filename)
-                if cnt.find("!code") >= 0:
-                    cnt = run_code_macros(cnt, app_dir)
-                library += cnt
             except IOError as e:
                 raise MacroError(str(e))
-            filenum += 1
+            deps = _new_deps()
+            deps['files'][os.path.relpath(filename, self.app_dir)] = stamp
+            self._stack.append(filename)
+            self._deps.append(deps)
+            try:
+                cnt = self.run_code_macros(cnt)
+            finally:
+                self._stack.pop()
+                self._deps.pop()
+            self._files[key] = (cnt, deps)
+
+        cnt, deps = self._files[key]
+        self._record(deps)
+        return cnt
 
-        if not filenum:
+    def _read_include(self, filename):
+        stamp = self._stamp(filename)
+        if stamp is None:
+            raise MacroError("Processing code: can't read '%s'" % filename)
+        key = (filename, stamp[1], stamp[0])
+        if key not in self._json_files:
+            logger.debug("process json macro: %s", filename)
+            try:
+                if filename.endswith('.json'):
+                    self._json_files[key] = util.read_json(filename)
+                else:
+                    self._json_files[key] = util.read(filename)
+            except IOError as e:
+                raise MacroError(str(e))
+        self._record({'files': {os.path.relpath(filename, self.app_dir): stamp}})
+        return self._json_files[key]
+
+    def _include_attachments(self, source, included):
+        filenames = self._glob(source)
+        self._record({'globs': {source: self._relpaths(filenames)}})
+        if not filenames:
             raise MacroError("Processing code: No file matching '%s'" %
-                             mo.group(2))
-        return library
+                             source)
+        for filename in filenames:
+            library = self._read_include(filename)
+            fields = os.path.relpath(filename, self.app_dir).split(os.sep)
+            include_to = included
+            for field in fields[:-1]:
+                include_to = include_to.setdefault(field, {})
+            include_to[fields[-1]] = library
 
-    re_code = re.compile('(\/\/|#)\ ?!code (.*)')
-    return re_code.sub(rreq, f_string)
+    def _include_fields(self, doc, source, included):
+        logger.debug("process json macro: %s", source)
+        self._record({'fields': {source: _field_hash(doc, source)}})
+        fields = source.split('.')
+        library = doc
+        count = len(fields)
+        include_to = included
+        for i, field in enumerate(fields):
+            if field not in library:
+                logger.warning("process json macro: unknown json. Source: %s", source)
+                break
+            library = library[field]
+            if i+1 < count:
+                include_to[field] = include_to.get(field, {})
+                include_to = include_to[field]
+            else:
+                include_to[field] = library
 
 
-def run_json_macros(doc, f_string, app_dir):
-    included = {}
-    varstrings = []
-
-    def rjson(mo):
-        if mo.group(2).startswith('_attachments'):
-            # someone  want to include from attachments
-            path = os.path.join(app_dir, mo.group(2).strip())
-            filenum = 0
-            for filename in glob.iglob(path):
-                logger.debug("process json macro: %s", filename)
-                library = ''
-                try:
-                    if filename.endswith('.json'):
-                        library = util.read_json(filename)
-                    else:
-                        library = util.read(filename)
-                except IOError as e:
-                    raise MacroError(str(e))
-                filenum += 1
-                current_file = filename.split(app_dir)[1]
-                fields = current_file.split('/')
-                count = len(fields)
-                include_to = included
-                for i, field in enumerate(fields):
-                    if i+1 < count:
-                        include_to[field] = {}
-                        include_to = include_to[field]
-                    else:
-                        include_to[field] = library
-            if not filenum:
-                raise MacroError("Processing code: No file matching '%s'" %
-                                 mo.group(2))
-        else:
-            logger.debug("process json macro: %s", mo.group(2))
-            fields = mo.group(2).strip().split('.')
-            library = doc
-            count = len(fields)
-            include_to = included
-            for i, field in enumerate(fields):
-                if field not in library:
-                    logger.warning("process json macro: unknown json. Source: %s", mo.group(2))
-                    break
-                library = library[field]
-                if i+1 < count:
-                    include_to[field] = include_to.get(field, {})
-                    include_to = include_to[field]
-                else:
-                    include_to[field] = library
+def _new_deps():
+    return {'files': {}, 'globs': {}, 'fields': {}}
+
+
+def _field_hash(doc, source):
+    """
+    Hash of the document value a ``!json`` macro refers to.
+    """
+    value = doc
+    for field in source.split('.'):
+        if not isinstance(value, dict) or field not in value:
+            value = None
+            break
+        value = value[field]
+    return md5(util.to_bytestring(
+        util.json.dumps(value, sort_keys=True))).hexdigest()
+
+
+def package_shows(doc, funcs, app_dir, objs):
+    MacroEngine(app_dir).package_shows(doc, funcs, objs)
 
-        return f_string
 
-    def rjson2(mo):
-        return '\n'.join(varstrings)
+def package_views(doc, views, app_dir, objs):
+    MacroEngine(app_dir).package_views(doc, views, objs)
+
+
+def apply_lib(doc, funcs, app_dir, objs):
+    MacroEngine(app_dir).apply_lib(doc, funcs, objs)
 
-    re_json = re.compile('(\/\/|#)\ ?!json (.*)')
-    re_json.sub(rjson, f_string)
 
-    if not included:
-        return f_string
+def run_code_macros(f_string, app_dir):
+    return MacroEngine(app_dir).run_code_macros(f_string)
 
-    for k, v in included.items():
-        varstrings.append("var %s = %s;" %
-                          (k, util.json.dumps(v).encode('utf-8')))
 
-    return re_json.sub(rjson2, f_string)
+def run_json_macros(doc, f_string, app_dir):
+    return MacroEngine(app_dir).run_json_macros(doc, f_string)
@@ -4,21 +4,53 @@
 # See the NOTICE for more information.
 
 import string
+import base64
 import codecs
+import hashlib
 import inspect
 import json
 import logging
+import mmap
 import os
 import re
 import subprocess
-from hashlib import md5
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from importlib import import_module, util
 from urllib.parse import urlparse, urlunparse
 
 from couchapp.errors import AppError, ScriptError
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 logger = logging.getLogger(__name__)
 
+# algorithms available to sign attachments, name -> hash constructor
+SIGNATURE_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+if xxhash is not None:
+    SIGNATURE_ALGORITHMS['xxh64'] = xxhash.xxh64
+    SIGNATURE_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+
+DEFAULT_SIGNATURE_ALGORITHM = 'md5'
+
+# size of the chunks files are streamed by
+READ_CHUNK_SIZE = 3 * 256 * 1024
+
+# files are read at once up to SIGN_BUFSIZE bytes, hashed by blocks of
+# SIGN_BUFSIZE bytes, or mapped in memory at once if they are bigger than
+# SIGN_MMAP_SIZE
+SIGN_BUFSIZE = 1024 * 1024
+SIGN_MMAP_SIZE = 16 * 1024 * 1024
+
+
 def user_rcpath():
     return [os.path.expanduser('~/.couchapp.conf')]
 
@@ -184,23 +216,40 @@ def split_path(path):
     return parts
 
 
-def sign(fpath):
-    """ return md5 hash from file content
+def sign(fpath, algorithm=DEFAULT_SIGNATURE_ALGORITHM):
+    """ return hash from file content
 
     :attr fpath: string, path of file
+    :attr algorithm: string, one of ``SIGNATURE_ALGORITHMS``
 
-    :return: string, md5 hexdigest
+    :return: string, hexdigest
     """
+    try:
+        m = SIGNATURE_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise AppError("unknown signature algorithm '{0}'".format(algorithm))
+
     if os.path.isfile(fpath):
-        m = md5()
         with open(fpath, 'rb') as fp:
             try:
-                while 1:
-                    data = fp.read(8096)
-                    if not data:
-                        break
-                    m.update(data)
-            except IOError as msg:
+                fsize = os.fstat(fp.fileno()).st_size
+                if fsize >= SIGN_MMAP_SIZE:
+                    with mmap.mmap(fp.fileno(), 0,
+                                   access=mmap.ACCESS_READ) as data:
+                        m.update(data)
+                elif fsize <= SIGN_BUFSIZE:
+                    # allocating the buffer costs more than hashing
+                    # a small file
+                    m.update(fp.read())
+                else:
+                    buf = bytearray(SIGN_BUFSIZE)
+                    view = memoryview(buf)
+                    while 1:
+                        size = fp.readinto(buf)
+                        if not size:
+                            break
+                        m.update(view[:size])
+            except (IOError, ValueError) as msg:
                 logger.error('%s: I/O error: %s\n', fpath, msg)
                 return 1
             return m.hexdigest()
@@ -230,6 +279,24 @@ def write(fname, content):
     """
     with open(fname, 'wb') as f:
         f.write(to_bytestring(content))
+        f.write(b'\n')
+
+
+def write_chunks(fname, chunks):
+    """ write the ``chunks`` (str) one after the other, followed by a
+    newline, in a file or on the standard output if ``fname`` is None.
+    Only one chunk is held in memory at a time.
+    """
+    if fname is None:
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+        return
+
+    with open(fname, 'w', encoding='utf-8') as f:
+        for chunk in chunks:
+            f.write(chunk)
         f.write('\n')
 
 
@@ -239,8 +306,11 @@ def write_json(fname, obj):
 
     :type fname: str
     :param obj: serializable builtin type,
-        or any obj has ``to_json`` method
+        or any obj has ``iter_json`` or ``to_json`` method
     """
+    if hasattr(obj, 'iter_json'):
+        write_chunks(fname, obj.iter_json())
+        return
     try:
         val = json.dumps(obj).encode('utf-8')
     except TypeError:
@@ -248,6 +318,31 @@ def write_json(fname, obj):
     write(fname, val)
 
 
+def iter_file(fname, chunk_size=READ_CHUNK_SIZE):
+    """ yield the content of the text file ``fname`` by chunks """
+    with open(fname, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_base64(fname, chunk_size=READ_CHUNK_SIZE):
+    """ yield the content of the file ``fname`` encoded in base64, by
+    chunks of about ``chunk_size`` bytes of input
+    """
+    # a multiple of 3 bytes is encoded without padding, the chunks can be
+    # concatenated
+    chunk_size -= chunk_size % 3
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield base64.b64encode(data).decode('ascii')
+
+
 def read_json(fname, use_environment=False, raise_on_error=False):
     """ read a json file and deserialize
 
@@ -387,6 +482,50 @@ def sh_open(cmd, bufsize=0):
     return (out, err)
 
 
+def run_parallel(func, items, jobs=1):
+    """
+    Call ``func(item)`` for each item of ``items``, running at most
+    ``jobs`` calls at the same time. A failing call doesn't prevent the
+    others from running.
+
+    :return: list of ``(item, result, error)`` tuples in the order of
+        ``items``, ``error`` being the exception raised by ``func`` or None
+    """
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(jobs, len(items))) as executor:
+        return list(executor.map(call, items))
+
+
+def pool_map(func, *iterables, workers=1, processes=False):
+    """
+    Same as ``map(func, *iterables)``, on a pool of ``workers`` threads,
+    or processes if ``processes`` is True (``func`` must then be a module
+    level function). Results are returned as a list, in order.
+    """
+    items = list(zip(*iterables))
+    if workers <= 1 or len(items) <= 1:
+        return [func(*args) for args in items]
+
+    workers = min(workers, len(items))
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        chunksize = max(1, len(items) // (workers * 4))
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        chunksize = 1
+    with executor:
+        return list(executor.map(func, *zip(*items), chunksize=chunksize))
+
+
 def is_empty_dir(path):
     if not os.listdir(path):
         return True
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+"""
+Watch the directory of an application and report the files changing
+under it, with inotify when ``inotify_simple`` is installed or by polling
+the tree otherwise.
+"""
+
+import logging
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+# seconds between two scans of the tree by the polling watcher
+POLL_INTERVAL = 0.2
+
+# seconds without change ending a burst of changes
+DEBOUNCE = 0.1
+
+
+class PollingWatcher(object):
+    """
+    Detect the changes by comparing the size, mtime and inode of all the
+    files of the tree every ``interval`` seconds.
+
+    :param skip: callable taking a path relative to ``path`` and
+        returning True if it must not be watched
+    """
+
+    def __init__(self, path, skip=None, interval=POLL_INTERVAL):
+        self.path = path
+        self.skip = skip or (lambda relpath: False)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        files = {}
+        stack = [(self.path, '')]
+        while stack:
+            current, rel = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                relpath = rel + entry.name
+                if self.skip(relpath):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, relpath + '/'))
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files[relpath] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return files
+
+    def poll(self, timeout=None):
+        """
+        Wait up to ``timeout`` seconds (forever if None) for changes.
+
+        :return: the set of the relative paths created, modified or
+            removed since the previous call
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = set(path for path in set(snapshot) | set(self._snapshot)
+                          if snapshot.get(path) != self._snapshot.get(path))
+            self._snapshot = snapshot
+            if changed:
+                return changed
+
+            if deadline is None:
+                time.sleep(self.interval)
+            else:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return changed
+                time.sleep(min(self.interval, left))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Detect the changes with inotify, watching each directory of the tree.
+
+    :param skip: callable taking a path relative to ``path`` and
+        returning True if it must not be watched
+    """
+
+    def __init__(self, path, skip=None):
+        flags = inotify_simple.flags
+        self.mask = (flags.CREATE | flags.DELETE | flags.MODIFY |
+                     flags.CLOSE_WRITE | flags.MOVED_FROM | flags.MOVED_TO |
+                     flags.ATTRIB | flags.DELETE_SELF)
+        self.path = path
+        self.skip = skip or (lambda relpath: False)
+        self._inotify = inotify_simple.INotify()
+        self._dirs = {}  # watch descriptor -> relative path of the dir
+        self._add_tree(path, '')
+
+    def _add_tree(self, path, rel):
+        """
+        Watch ``path`` and its sub directories.
+
+        :return: the relative paths of the files found under ``path``
+        """
+        found = []
+        stack = [(path, rel)]
+        while stack:
+            current, rel = stack.pop()
+            try:
+                wd = self._inotify.add_watch(current, self.mask)
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            self._dirs[wd] = rel
+            for entry in entries:
+                relpath = rel + entry.name
+                if self.skip(relpath):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, relpath + '/'))
+                else:
+                    found.append(relpath)
+        return found
+
+    def poll(self, timeout=None):
+        """
+        Wait up to ``timeout`` seconds (forever if None) for changes.
+
+        :return: the set of the relative paths created, modified or
+            removed since the previous call
+        """
+        flags = inotify_simple.flags
+        changed = set()
+        ms = None if timeout is None else int(timeout * 1000)
+        for event in self._inotify.read(timeout=ms):
+            if event.mask & flags.IGNORED:
+                self._dirs.pop(event.wd, None)
+                continue
+            rel = self._dirs.get(event.wd)
+            if rel is None or not event.name:
+                continue
+            relpath = rel + event.name
+            if self.skip(relpath):
+                continue
+            changed.add(relpath)
+            if event.mask & flags.ISDIR and \
+                    event.mask & (flags.CREATE | flags.MOVED_TO):
+                # files may have been written before the watch was added
+                changed.update(self._add_tree(os.path.join(self.path, relpath),
+                                              relpath + '/'))
+        return changed
+
+    def close(self):
+        self._inotify.close()
+
+
+def watcher(path, skip=None, polling=False, interval=POLL_INTERVAL):
+    """
+    Return an inotify watcher of ``path`` if available, else a polling one.
+    """
+    if inotify_simple is not None and not polling:
+        try:
+            return InotifyWatcher(path, skip)
+        except OSError as e:
+            logger.warning("can't use inotify (%s), polling %s", e, path)
+    return PollingWatcher(path, skip, interval)
+
+
+def wait_changes(watcher, debounce=DEBOUNCE):
+    """
+    Block until files change, then keep collecting the changes until
+    none happened for ``debounce`` seconds, so that a burst of writes
+    (an editor saving, a ``git checkout``) is handled once.
+
+    :return: the set of the relative paths changed
+    """
+    changed = set()
+    while not changed:
+        changed = watcher.poll()
+    while True:
+        more = watcher.poll(debounce)
+        if not more:
+            return changed
+        changed |= more
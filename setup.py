@@ -45,6 +45,12 @@ def main():
         long_description = f.read()
 
     INSTALL_REQUIRES = ['requests>=2.20.0']
+    # optional: asyncio client, inotify watch and xxhash signatures
+    EXTRAS_REQUIRE = {
+        'async': ['aiohttp>=3.8'],
+        'inotify': ['inotify_simple'],
+        'xxhash': ['xxhash'],
+    }
 
     options = dict(
             name='CMSCouchapp',
@@ -63,6 +69,7 @@ def main():
             include_package_data=True,
             zip_safe=False,
             install_requires=INSTALL_REQUIRES,
+            extras_require=EXTRAS_REQUIRE,
             entry_points={
                 'console_scripts': [
                     'couchapp = couchapp.commands:main'